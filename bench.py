@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+
+"""
+Measure sfuzz's own overhead against stand-in devices on local ptys
+Devices are served from their own processes so only sfuzz's CPU is counted
+ex: ./bench.py --cases 2000 --engines sync,batch
+"""
+
+import argparse
+import collections
+import multiprocessing
+import os
+import pty
+import sys
+import tempfile
+import time
+import timeit
+import tty
+
+from capture import CaptureWriter
+from main import SFuzz, SerConfig, RxCompletion, hexdump, bytes2AnonArray
+
+
+def silent():
+    return lambda data: None
+
+
+def echo():
+    return lambda data: data
+
+
+def delayed_echo(delay=0.002):
+    def handle(data):
+        time.sleep(delay)
+        return data
+
+    return handle
+
+
+def line_protocol():
+    '''Answers each \\r or \\n terminated line, OK if it starts with A'''
+    buf = bytearray()
+
+    def handle(data):
+        buf.extend(data.replace(b"\r", b"\n"))
+        ret = b""
+        while b"\n" in buf:
+            line, _nl, rest = bytes(buf).partition(b"\n")
+            buf[:] = rest
+            if line:
+                ret += b"OK\r\n" if line.startswith(b"A") else b"ERR\r\n"
+        return ret
+
+    return handle
+
+
+DEVICES = collections.OrderedDict([
+    ("silent", silent),
+    ("echo", echo),
+    ("delayed_echo", delayed_echo),
+    ("line", line_protocol),
+])
+ENGINES = ["sync", "batch"]
+
+
+def device_loop(fd, name):
+    handle = DEVICES[name]()
+    while True:
+        try:
+            data = os.read(fd, 4096)
+        except OSError:
+            return
+        reply = handle(data)
+        if reply:
+            os.write(fd, reply)
+
+
+class PtyDevice(object):
+    def __init__(self, name):
+        self.name = name
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.proc = multiprocessing.Process(target=device_loop,
+                                            args=(self.master, name),
+                                            daemon=True)
+        self.proc.start()
+
+    def close(self):
+        self.proc.terminate()
+        self.proc.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+
+class CountingWriter(object):
+    '''Stands in for the log, only counts what would have been written'''
+    def __init__(self):
+        self.bytes = 0
+
+    def write(self, data):
+        self.bytes += len(data)
+
+    def flush(self):
+        pass
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, len(values) * p // 100)]
+
+
+def bench_engine(device, engine, cases, batch=32):
+    '''Returns dict of cases/s, exchange time per case p50 / p99 (ms), CPU us / case, log / capture bytes per case'''
+    fd, fn = tempfile.mkstemp(suffix=".sfz")
+    os.close(fd)
+    capture = CaptureWriter(fn)
+    sf = SFuzz(port=device.port,
+               baudrates=[115200],
+               parities=['N'],
+               stopbitss=[1],
+               seed=1,
+               capture=capture,
+               # ptys hand rx over right away, no adapter to wait out
+               completion=RxCompletion(latency=0.001),
+               batch=batch if engine == "batch" else 1)
+    # Per case time on the wire. A batch goes out as one exchange: its time
+    # is split evenly over its cases (bisect resends count as exchanges too)
+    exchanges = []
+
+    def timed(fn, size):
+        def wrapper(*args):
+            start = time.monotonic_ns()
+            ret = fn(*args)
+            n = size(*args)
+            exchanges.extend([(time.monotonic_ns() - start) / n] * n)
+            return ret
+
+        return wrapper
+
+    sf.txrx_case = timed(sf.txrx_case, lambda itr, tx: 1)
+    sf.txrx_batch = timed(sf.txrx_batch, lambda txs: len(txs))
+    out = CountingWriter()
+    real = sys.stdout
+    sys.stdout = out
+    tstart = time.monotonic()
+    cpu_start = time.process_time()
+    try:
+        sf.run(count=cases)
+    finally:
+        sys.stdout = real
+    cpu = time.process_time() - cpu_start
+    dt = time.monotonic() - tstart
+    capture.close()
+    capture_bytes = os.path.getsize(fn)
+    os.remove(fn)
+    sf.ser.close()
+    return collections.OrderedDict([
+        ("cases/s", cases / dt),
+        ("p50 ms", percentile(exchanges, 50) / 1e6),
+        ("p99 ms", percentile(exchanges, 99) / 1e6),
+        ("cpu us/case", cpu / cases * 1e6),
+        ("log B/case", out.bytes / cases),
+        ("capture B/case", capture_bytes / cases),
+    ])
+
+
+def micro_benchmarks():
+    '''[(name, ns per call)] for the per case hot spots'''
+    sf = SFuzz(port=os.devnull, seed=1)
+    sf.itr = 0
+    settings = SerConfig(115200, 'N', 1, False, False, False)
+    data = bytes(range(64))
+    fd, fn = tempfile.mkstemp(suffix=".sfz")
+    os.close(fd)
+    capture = CaptureWriter(fn)
+    out = CountingWriter()
+    itr = iter(range(1 << 62))
+    tests = [
+        ("get_tx(16)", lambda: sf.get_tx(16)),
+        ("next_case()", sf.next_case),
+        ("hexdump 64 B", lambda: hexdump(data, label="rx 64", f=out)),
+        ("bytes2AnonArray 64 B", lambda: bytes2AnonArray(data)),
+        ("novelty check", lambda: sf.novelty_index.check(data[0:8], data, settings)),
+        ("capture exchange", lambda: capture.exchange(next(itr), settings, data[0:8], data)),
+    ]
+    ret = []
+    real = sys.stdout
+    sys.stdout = out
+    try:
+        for name, fn_ in tests:
+            timer = timeit.Timer(fn_)
+            number, _t = timer.autorange()
+            ret.append((name, min(timer.repeat(3, number)) / number * 1e9))
+    finally:
+        sys.stdout = real
+        capture.close()
+        os.remove(fn)
+    return ret
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark sfuzz against pty stand-in devices")
+    parser.add_argument("--cases", default=1000, type=int, help="Cases per device / engine")
+    parser.add_argument("--devices", default=",".join(DEVICES), help="Comma separated: %s" % ", ".join(DEVICES))
+    parser.add_argument("--engines", default=",".join(ENGINES), help="Comma separated: %s" % ", ".join(ENGINES))
+    parser.add_argument("--batch", default=32, type=int, help="Cases per batch for the batch engine")
+    parser.add_argument("--no-micro", action="store_true", help="Skip the micro benchmarks")
+    args = parser.parse_args()
+
+    if not args.no_micro:
+        print("Micro benchmarks")
+        for name, ns in micro_benchmarks():
+            print("  %-24s %10.0f ns" % (name, ns))
+        print("")
+
+    header = None
+    for name in args.devices.split(","):
+        device = PtyDevice(name)
+        try:
+            for engine in args.engines.split(","):
+                result = bench_engine(device, engine, args.cases, args.batch)
+                if header is None:
+                    header = "%-14s %-6s" % ("device", "engine") + "".join(
+                        " %14s" % col for col in result)
+                    print(header)
+                print("%-14s %-6s" % (name, engine) + "".join(
+                    " %14.1f" % value for value in result.values()))
+                sys.stdout.flush()
+        finally:
+            device.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,315 @@
+"""
+Compact binary record of every tx/rx exchange
+
+File: MAGIC, then records of
+    u32 body length, u8 type, body
+Record types
+    S: session info, JSON
+    C: u16 config id + JSON list of SerConfig fields
+    X: EXCHANGE header + tx + rx
+    L: CHUNK per rx chunk of the X before it (only if rx came in pieces)
+Little endian throughout
+
+CaptureIndex keeps sorted lookup columns next to it in <capture>.idx
+"""
+
+import array
+import atexit
+import bisect
+import collections
+import hashlib
+import json
+import mmap
+import os
+import struct
+import time
+
+MAGIC = b"SFZCAP\x00\x01"
+RECORD = struct.Struct("<IB")
+CONFIG = struct.Struct("<H")
+# itr, tx wall clock ns, first / last rx byte ns after tx, config id, tx length
+EXCHANGE = struct.Struct("<QQIIHH")
+# ns offsets are u32, saturate ~4.3 s after tx
+DT_MAX = 0xFFFFFFFF
+# rx chunk ns after tx, length
+CHUNK = struct.Struct("<IH")
+
+REC_SESSION = ord("S")
+REC_CONFIG = ord("C")
+REC_EXCHANGE = ord("X")
+REC_LATENCY = ord("L")
+
+INDEX_MAGIC = b"SFZIDX\x00\x01"
+# magic, capture size indexed, meta records, rows
+INDEX_HDR = struct.Struct("<8sQQQ")
+# Each a sorted column of key << 32 | row
+INDEX_KEYS = ("config", "rxlen", "prefix", "hash")
+ROW_MASK = 0xFFFFFFFF
+
+# chunks: [(ns after tx, bytes)] per rx chunk
+Exchange = collections.namedtuple(
+    "Exchange", "offset itr t_ns rx_first_ns rx_last_ns config tx rx chunks")
+
+
+class CaptureWriter(object):
+    '''Appends exchanges with large buffered writes'''
+    def __init__(self, fn, session=None, buffering=1 << 20):
+        self.fn = fn
+        new = not os.path.exists(fn) or os.path.getsize(fn) == 0
+        self.f = open(fn, 'ab', buffering=buffering)
+        if new:
+            self.f.write(MAGIC)
+        # config => id
+        self.config_ids = {}
+        # Ids are per file, continue after what earlier sessions defined
+        if not new:
+            reader = CaptureReader(fn)
+            self.config_ids = dict((tuple(config), configi)
+                                   for configi, config in reader.configs.items())
+            reader.close()
+        session = dict(session or {})
+        session.setdefault("start", time.time())
+        self.record(REC_SESSION, json.dumps(session).encode('utf-8'))
+        atexit.register(self.close)
+
+    def record(self, rectype, body):
+        self.f.write(RECORD.pack(len(body), rectype))
+        self.f.write(body)
+
+    def config_id(self, config):
+        key = tuple(config)
+        ret = self.config_ids.get(key)
+        if ret is None:
+            ret = len(self.config_ids)
+            self.config_ids[key] = ret
+            self.record(
+                REC_CONFIG,
+                CONFIG.pack(ret) + json.dumps(list(config)).encode('utf-8'))
+        return ret
+
+    def exchange(self, itr, config, tx, rx, t_ns=0, rx_first_ns=0,
+                 rx_last_ns=0, chunks=None):
+        hdr = EXCHANGE.pack(itr, t_ns, min(rx_first_ns, DT_MAX),
+                            min(rx_last_ns, DT_MAX), self.config_id(config),
+                            len(tx))
+        self.f.write(
+            RECORD.pack(len(hdr) + len(tx) + len(rx), REC_EXCHANGE))
+        self.f.write(hdr)
+        self.f.write(tx)
+        self.f.write(rx)
+        if chunks and len(chunks) > 1:
+            self.record(
+                REC_LATENCY,
+                b"".join(CHUNK.pack(min(dt, DT_MAX), min(n, 0xFFFF))
+                         for dt, n in chunks))
+
+    def flush(self):
+        if self.f:
+            self.f.flush()
+
+    def close(self):
+        if self.f:
+            self.f.close()
+            self.f = None
+
+
+class CaptureReader(object):
+    '''mmap a capture, exchanges come back as zero copy memoryviews'''
+    def __init__(self, fn, scan=True):
+        self.fn = fn
+        self.f = open(fn, 'rb')
+        size = os.fstat(self.f.fileno()).st_size
+        if size == 0:
+            self.mm = b""
+        else:
+            self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.mm) and self.mm[0:len(MAGIC)] != MAGIC:
+            raise ValueError("%s: not a capture file" % fn)
+        self.view = memoryview(self.mm)
+        # id => list of SerConfig fields
+        self.configs = {}
+        self.sessions = []
+        if scan:
+            self.scan_meta()
+
+    def close(self):
+        self.view.release()
+        if not isinstance(self.mm, bytes):
+            self.mm.close()
+        self.f.close()
+
+    def records(self, offset=None):
+        '''Yields (offset, type, body start, body end)'''
+        if offset is None:
+            offset = len(MAGIC)
+        end = len(self.mm)
+        while offset + RECORD.size <= end:
+            length, rectype = RECORD.unpack_from(self.mm, offset)
+            start = offset + RECORD.size
+            if start + length > end:
+                # Truncated by a crash mid write
+                break
+            yield offset, rectype, start, start + length
+            offset = start + length
+
+    def scan_meta(self):
+        for offset, rectype, _start, _end in self.records():
+            if rectype in (REC_SESSION, REC_CONFIG):
+                self.meta_at(offset)
+
+    def meta_at(self, offset):
+        length, rectype = RECORD.unpack_from(self.mm, offset)
+        start = offset + RECORD.size
+        end = start + length
+        if rectype == REC_CONFIG:
+            (configi, ) = CONFIG.unpack_from(self.mm, start)
+            self.configs[configi] = json.loads(
+                bytes(self.mm[start + CONFIG.size:end]).decode('utf-8'))
+        elif rectype == REC_SESSION:
+            self.sessions.append(
+                json.loads(bytes(self.mm[start:end]).decode('utf-8')))
+
+    def exchange_at(self, offset):
+        length, rectype = RECORD.unpack_from(self.mm, offset)
+        assert rectype == REC_EXCHANGE
+        start = offset + RECORD.size
+        return self.decode(offset, start, start + length)
+
+    def decode(self, offset, start, end):
+        itr, t_ns, first, last, configi, tx_len = EXCHANGE.unpack_from(
+            self.mm, start)
+        tx_start = start + EXCHANGE.size
+        rx = self.view[tx_start + tx_len:end]
+        return Exchange(offset, itr, t_ns, first, last,
+                        self.configs.get(configi),
+                        self.view[tx_start:tx_start + tx_len], rx,
+                        self.chunks_at(end, first, len(rx)))
+
+    def chunks_at(self, offset, first, rx_len):
+        '''Chunk profile from the L record at offset, if there is one'''
+        if offset + RECORD.size <= len(self.mm):
+            length, rectype = RECORD.unpack_from(self.mm, offset)
+            start = offset + RECORD.size
+            if rectype == REC_LATENCY and start + length <= len(self.mm):
+                return list(CHUNK.iter_unpack(self.mm[start:start + length]))
+        if rx_len:
+            return [(first, rx_len)]
+        return []
+
+    def __iter__(self):
+        for offset, rectype, start, end in self.records():
+            if rectype == REC_EXCHANGE:
+                yield self.decode(offset, start, end)
+
+
+def rx_prefix_key(rx):
+    '''First 4 rx bytes as a big endian number, zero padded'''
+    return int.from_bytes(bytes(rx[0:4]).ljust(4, b"\x00"), "big")
+
+
+def rx_prefix_range(prefix):
+    '''[lo, hi) of rx_prefix_key() for rx starting with prefix (first 4 bytes only)'''
+    prefix = bytes(prefix[0:4])
+    shift = 8 * (4 - len(prefix))
+    lo = int.from_bytes(prefix, "big") << shift if prefix else 0
+    return lo, lo + (1 << shift)
+
+
+def rx_hash_key(rx):
+    '''32 bit rx hash, collisions are weeded out by comparing rx'''
+    return int.from_bytes(
+        hashlib.blake2b(rx, digest_size=4).digest(), "little")
+
+
+class CaptureIndex(object):
+    '''
+    On disk indexes over a capture (capture.sfz.idx)
+    Columns are sorted key << 32 | row so a lookup is a bisect on the mmap
+    Rebuilt when the capture has grown since
+    Also remembers where the config / session records are so the reader
+    can skip its full scan_meta() (CaptureReader(fn, scan=False))
+    '''
+    def __init__(self, reader, fn=None, rebuild=False):
+        self.reader = reader
+        self.fn = fn or reader.fn + ".idx"
+        self.mm = None
+        if rebuild or not self.load():
+            self.save(*self.build())
+            assert self.load()
+        if not reader.configs and not reader.sessions:
+            for offset in self.meta:
+                reader.meta_at(offset)
+
+    def build(self):
+        mm = self.reader.mm
+        meta = array.array('Q')
+        offsets = array.array('Q')
+        cols = dict((key, array.array('Q')) for key in INDEX_KEYS)
+        for offset, rectype, start, end in self.reader.records():
+            if rectype in (REC_SESSION, REC_CONFIG):
+                meta.append(offset)
+            if rectype != REC_EXCHANGE:
+                continue
+            row = len(offsets)
+            offsets.append(offset)
+            _itr, _t_ns, _first, _last, configi, tx_len = EXCHANGE.unpack_from(
+                mm, start)
+            rx = mm[start + EXCHANGE.size + tx_len:end]
+            cols["config"].append(configi << 32 | row)
+            cols["rxlen"].append(len(rx) << 32 | row)
+            cols["prefix"].append(rx_prefix_key(rx) << 32 | row)
+            cols["hash"].append(rx_hash_key(rx) << 32 | row)
+        for key in INDEX_KEYS:
+            cols[key] = array.array('Q', sorted(cols[key]))
+        return meta, offsets, cols
+
+    def save(self, meta, offsets, cols):
+        tmp = self.fn + ".tmp"
+        with open(tmp, 'wb') as f:
+            f.write(
+                INDEX_HDR.pack(INDEX_MAGIC, len(self.reader.mm), len(meta),
+                               len(offsets)))
+            meta.tofile(f)
+            offsets.tofile(f)
+            for key in INDEX_KEYS:
+                cols[key].tofile(f)
+        os.replace(tmp, self.fn)
+
+    def load(self):
+        if not os.path.exists(self.fn):
+            return False
+        with open(self.fn, 'rb') as f:
+            hdr = f.read(INDEX_HDR.size)
+            if len(hdr) < INDEX_HDR.size:
+                return False
+            magic, size, metas, rows = INDEX_HDR.unpack(hdr)
+            if magic != INDEX_MAGIC or size != len(self.reader.mm):
+                return False
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.mm)
+        pos = INDEX_HDR.size
+        self.meta = view[pos:pos + 8 * metas].cast('Q')
+        pos += 8 * metas
+        self.offsets = view[pos:pos + 8 * rows].cast('Q')
+        self.cols = {}
+        for key in INDEX_KEYS:
+            pos += 8 * rows
+            self.cols[key] = view[pos:pos + 8 * rows].cast('Q')
+        return True
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def span(self, key, lo, hi):
+        '''Column positions [first, last) with lo <= key < hi'''
+        col = self.cols[key]
+        return (bisect.bisect_left(col, lo << 32),
+                bisect.bisect_left(col, hi << 32))
+
+    def rows(self, key, lo, hi):
+        col = self.cols[key]
+        first, last = self.span(key, lo, hi)
+        return [col[i] & ROW_MASK for i in range(first, last)]
+
+    def exchange(self, row):
+        return self.reader.exchange_at(self.offsets[row])
@@ -0,0 +1,247 @@
+"""
+Command grammars: generate valid-ish commands for line oriented targets
+
+    # comment
+    start = cmd term | cmd sep cmd term
+    cmd = "*" name | name arg
+    name = "VN" | "ON" | "OF"
+    arg = int(0, 9999) | hex(2, 4)
+    sep = " " | ","
+    term = "\\r" | "\\r\\n"
+
+Alternatives are separated by |, a line starting with | continues the rule
+above. A sequence is "literals" (backslash escapes ok), rule names and typed
+args: int(lo, hi) decimal numbers, hex / alpha / alnum / digits / print /
+bytes(lo, hi) strings of lo to hi characters (kind(n): exactly n)
+Rules can't refer back to themselves, spell out repeats instead
+
+Enumerating gives every combination, typed args contributing their edge
+cases (ends of the range and one past). Sampling picks alternatives evenly
+and typed args mostly in range, sometimes an edge case
+"""
+
+import codecs
+import re
+
+# Typed arg character sets
+ARG_ALPHABETS = {
+    "hex": b"0123456789ABCDEF",
+    "alpha": b"ABCDEFGHIJKLMNOPQRSTUVWXYZ",
+    "alnum": b"ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789",
+    "digits": b"0123456789",
+    "print": bytes(range(0x20, 0x7F)),
+    "bytes": bytes(range(256)),
+}
+ARG_KINDS = ["int"] + sorted(ARG_ALPHABETS)
+# Odds a sampled typed arg is one of its edge cases instead
+EDGE_PROB = 1 / 16.
+# Rules with up to this many expansions are expanded once and sampled from
+CACHE_MAX = 4096
+
+TOKEN_RE = re.compile(
+    r'\s*(?:"((?:[^"\\]|\\.)*)"|(\w+)\(([^)]*)\)|(\w+)|(\|))')
+RULE_RE = re.compile(r"^(\w+)\s*=(.*)$")
+
+
+class ArgType(object):
+    '''A typed arg, int(lo, hi) or kind(lo, hi) characters long'''
+    def __init__(self, kind, lo, hi=None):
+        if kind not in ARG_KINDS:
+            raise ValueError("Unknown arg type %s, need one of %s" %
+                             (kind, ", ".join(ARG_KINDS)))
+        self.kind = kind
+        self.lo = lo
+        self.hi = lo if hi is None else hi
+        self.edges = self.edge_cases()
+
+    def edge_cases(self):
+        if self.kind == "int":
+            values = [self.lo, self.hi, 0, self.lo - 1, self.hi + 1]
+            ret = [str(value).encode('ascii') for value in values]
+        else:
+            alphabet = ARG_ALPHABETS[self.kind]
+            ret = [alphabet[0:1] * self.lo, alphabet[-1:] * self.hi,
+                   alphabet[-1:] * (self.hi + 1)]
+            if self.lo:
+                ret.append(alphabet[0:1] * (self.lo - 1))
+        return list(dict.fromkeys(ret))
+
+    def sample(self, rng):
+        if rng.random() < EDGE_PROB:
+            return rng.choice(self.edges)
+        if self.kind == "int":
+            return str(rng.randint(self.lo, self.hi)).encode('ascii')
+        return bytes(
+            rng.choices(ARG_ALPHABETS[self.kind],
+                        k=rng.randint(self.lo, self.hi)))
+
+    def __str__(self):
+        return "%s(%u, %u)" % (self.kind, self.lo, self.hi)
+
+
+def parse_alternatives(text, fn="grammar", lineno=0):
+    '''Right hand side of a rule => [[symbol, ...] per alternative]'''
+    ret = [[]]
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        m = TOKEN_RE.match(text, pos)
+        if not m or m.end() == pos:
+            raise ValueError("%s:%u: can't parse %r" % (fn, lineno, text[pos:]))
+        pos = m.end()
+        literal, kind, args, name, bar = m.groups()
+        if bar:
+            ret.append([])
+        elif literal is not None:
+            ret[-1].append(codecs.escape_decode(literal.encode('latin-1'))[0])
+        elif kind:
+            ret[-1].append(
+                ArgType(kind, *[int(arg, 0) for arg in args.split(",")]))
+        else:
+            ret[-1].append(name)
+    return ret
+
+
+class Grammar(object):
+    '''
+    rules: name => [[symbol, ...] per alternative]
+    A symbol is a literal (bytes), a rule name (str) or an ArgType
+    '''
+    def __init__(self, rules, start="start"):
+        self.rules = rules
+        self.start = start
+        if start not in rules:
+            raise ValueError("Grammar has no %s rule" % start)
+        for name, alternatives in rules.items():
+            for alternative in alternatives:
+                for symbol in alternative:
+                    if isinstance(symbol, str) and symbol not in rules:
+                        raise ValueError("Rule %s refers to undefined %s" %
+                                         (name, symbol))
+        # name => expansions, see count()
+        self.counts = {}
+        self.check_recursion(start, [])
+        # name => every expansion, for rules small enough and without typed args
+        self.expansions = {}
+        for name in rules:
+            if self.static(name) and self.count(name) <= CACHE_MAX:
+                self.expansions[name] = [
+                    self.nth(i, name) for i in range(self.count(name))
+                ]
+
+    @staticmethod
+    def load(fn, start="start"):
+        rules = {}
+        name = None
+        with open(fn) as f:
+            for lineno, line in enumerate(f, 1):
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                if line.startswith("|"):
+                    if name is None:
+                        raise ValueError("%s:%u: | outside a rule" % (fn, lineno))
+                    # Continuation: the leading | starts a new alternative
+                    rules[name] += parse_alternatives(line[1:], fn, lineno)
+                    continue
+                m = RULE_RE.match(line)
+                if not m:
+                    raise ValueError("%s:%u: expect name = ..." % (fn, lineno))
+                name = m.group(1)
+                if name in rules:
+                    raise ValueError("%s:%u: %s defined twice" % (fn, lineno, name))
+                rules[name] = parse_alternatives(m.group(2), fn, lineno)
+        return Grammar(rules, start=start)
+
+    def check_recursion(self, name, path):
+        if name in path:
+            raise ValueError("Rule %s is recursive: %s" %
+                             (name, " => ".join(path + [name])))
+        for alternative in self.rules[name]:
+            for symbol in alternative:
+                if isinstance(symbol, str):
+                    self.check_recursion(symbol, path + [name])
+
+    def static(self, name):
+        '''No typed args anywhere below'''
+        for alternative in self.rules[name]:
+            for symbol in alternative:
+                if isinstance(symbol, ArgType):
+                    return False
+                if isinstance(symbol, str) and not self.static(symbol):
+                    return False
+        return True
+
+    def symbol_count(self, symbol):
+        if isinstance(symbol, bytes):
+            return 1
+        if isinstance(symbol, ArgType):
+            return len(symbol.edges)
+        return self.count(symbol)
+
+    def alternative_count(self, alternative):
+        ret = 1
+        for symbol in alternative:
+            ret *= self.symbol_count(symbol)
+        return ret
+
+    def count(self, name=None):
+        '''Number of enumerated expansions'''
+        name = name or self.start
+        ret = self.counts.get(name)
+        if ret is None:
+            ret = sum(self.alternative_count(alternative)
+                      for alternative in self.rules[name])
+            self.counts[name] = ret
+        return ret
+
+    def symbol_nth(self, symbol, i):
+        if isinstance(symbol, bytes):
+            return symbol
+        if isinstance(symbol, ArgType):
+            return symbol.edges[i]
+        return self.nth(i, symbol)
+
+    def nth(self, i, name=None):
+        '''Expansion i of count() without generating the ones before it'''
+        name = name or self.start
+        expansions = self.expansions.get(name)
+        if expansions is not None:
+            return expansions[i]
+        for alternative in self.rules[name]:
+            n = self.alternative_count(alternative)
+            if i >= n:
+                i -= n
+                continue
+            # Mixed radix, last symbol varies fastest
+            parts = []
+            for symbol in reversed(alternative):
+                i, digit = divmod(i, self.symbol_count(symbol))
+                parts.append(self.symbol_nth(symbol, digit))
+            return b"".join(reversed(parts))
+        raise IndexError("%s has %u expansions" % (name, self.count(name)))
+
+    def enumerate(self, name=None):
+        for i in range(self.count(name)):
+            yield self.nth(i, name)
+
+    def sample(self, rng, name=None):
+        name = name or self.start
+        expansions = self.expansions.get(name)
+        if expansions is not None:
+            return rng.choice(expansions)
+        return b"".join(
+            symbol if isinstance(symbol, bytes) else
+            symbol.sample(rng) if isinstance(symbol, ArgType) else
+            self.sample(rng, symbol)
+            for symbol in rng.choice(self.rules[name]))
+
+    def tokens(self, min_len=2):
+        '''Literals worth splicing into mutants'''
+        ret = []
+        for alternatives in self.rules.values():
+            for alternative in alternatives:
+                for symbol in alternative:
+                    if isinstance(symbol, bytes) and len(symbol) >= min_len:
+                        ret.append(symbol)
+        return list(dict.fromkeys(ret))
@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 
 import argparse
-import serial
+import contextlib
+import itertools
+import multiprocessing
+import queue
 import os
 import time
 import platform
@@ -12,12 +15,645 @@ import string
 import shutil
 import datetime
 import errno
+import select
+import signal
+import threading
+import atexit
+import bisect
+import codecs
+import collections
+import hashlib
+import math
+import re
+import struct
+try:
+    import termios
+except ImportError:
+    termios = None
+
+import serial
+
+from capture import CaptureWriter
+from sim import SIM_DEVICES
+from grammar import Grammar
 
 
 class Timeout(Exception):
     pass
 
 
+BAUDRATES = [9600, 19200, 38400, 115200]
+PARITIES = [
+    serial.PARITY_NONE, serial.PARITY_EVEN, serial.PARITY_ODD,
+    serial.PARITY_MARK, serial.PARITY_SPACE
+]
+STOPBITSS = [
+    serial.STOPBITS_ONE, serial.STOPBITS_ONE_POINT_FIVE, serial.STOPBITS_TWO
+]
+PRINTABLE = bytes(range(0x20, 0x7F)) + b"\t\r\n"
+ASCII_ALPHABET = (string.ascii_uppercase + string.digits).encode('ascii')
+# Includes oddballs (ex: DMX at 250000) that nobody would guess by hand
+AUTOBAUD_RATES = [
+    1200, 2400, 4800, 9600, 14400, 19200, 38400, 57600, 115200, 230400,
+    250000, 460800, 500000, 921600, 1000000
+]
+# Things a console or modem style target tends to answer
+AUTOBAUD_PROBES = [b"\r", b"\r\n", b"?\r\n", b"AT\r", b"help\r\n", b"\x1B"]
+
+
+class SerConfig(
+        collections.namedtuple(
+            "SerConfig", "baudrate parity stopbits rtscts dsrdtr xonxoff")):
+    '''One combination of line settings'''
+    __slots__ = ()
+
+    def __str__(self):
+        ret = "baudrate=%s, parity=%s, stopbits=%s" % (
+            self.baudrate, self.parity, self.stopbits)
+        for name in ("rtscts", "dsrdtr", "xonxoff"):
+            if getattr(self, name):
+                ret += ", %s=True" % name
+        return ret
+
+
+def ser_configs(baudrates, parities, stopbitss, rtsctss=[False],
+                dsrdtrs=[False], xonxoffs=[False]):
+    '''Full cartesian product of line settings'''
+    return [
+        SerConfig(*config)
+        for config in itertools.product(baudrates, parities, stopbitss,
+                                        rtsctss, dsrdtrs, xonxoffs)
+    ]
+
+
+def rx_score(rx):
+    '''0 for silence, 0.5 for pure garbage, up to 1 for all printable'''
+    if not len(rx):
+        return 0.0
+    junk = len(bytes(rx).translate(None, PRINTABLE))
+    return 0.5 + 0.5 * (len(rx) - junk) / len(rx)
+
+
+def alphabet_table(alphabet):
+    '''
+    (bytes.translate() table, delete) mapping uniform random bytes uniformly
+    onto alphabet: each byte maps to alphabet[b % n] and the few top values
+    that would bias the result are deleted in the same pass
+    '''
+    n = len(alphabet)
+    assert n, "empty alphabet"
+    table = bytes(alphabet[i % n] for i in range(256))
+    delete = bytes(range(256 - 256 % n, 256))
+    return table, delete
+
+
+def parse_byteset(s):
+    '''"20-7E,0D,0A" => bytes'''
+    ret = bytearray()
+    for part in s.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            first, last = part.split("-")
+            ret += bytes(range(int(first, 16), int(last, 16) + 1))
+        else:
+            ret.append(int(part, 16))
+    return bytes(ret)
+
+
+class ByteSpec(object):
+    '''
+    Declarative constraints on generated payload bytes
+    allow: bytes that may be sent (default: all)
+    forbid: bytes that are never sent, even in the middle of a payload
+    mask7: 7 bit values only
+    weights: {byte: relative weight}, unlisted allowed bytes weigh 1
+    prefixes / suffixes: byte strings, one is added with prefix_prob / suffix_prob
+
+    Compiles to a single 256 entry translate table so a payload costs O(n)
+    and never has to be regenerated, however tight the constraints
+    '''
+    def __init__(self,
+                 allow=None,
+                 forbid=b"",
+                 mask7=False,
+                 weights=None,
+                 prefixes=None,
+                 prefix_prob=0.0,
+                 suffixes=None,
+                 suffix_prob=0.0):
+        if allow is None:
+            allow = bytes(range(256))
+        self.forbid = bytes(forbid)
+        self.mask7 = mask7
+        self.alphabet = bytes(
+            b for b in sorted(set(allow)) if not self.forbidden(b))
+        assert self.alphabet, "constraints leave no bytes to send"
+        self.weights = weights
+        self.prefixes = prefixes or []
+        self.prefix_prob = prefix_prob
+        self.suffixes = suffixes or []
+        self.suffix_prob = suffix_prob
+        self._table = None
+
+    def forbidden(self, b):
+        '''Never sent, not even by mutants (allow only limits generated bytes)'''
+        return b in self.forbid or bool(self.mask7 and b & 0x80)
+
+    def table(self):
+        '''(bytes.translate() table, delete)'''
+        if self._table is None:
+            if not self.weights:
+                self._table = alphabet_table(self.alphabet)
+            else:
+                self._table = (self.weighted_table(), b"")
+        return self._table
+
+    def weighted_table(self):
+        '''
+        Share the 256 random byte values out proportionally to weight
+        (largest remainder), every allowed byte gets at least one value
+        '''
+        weights = [
+            max(0.0, float(self.weights.get(b, 1.0))) for b in self.alphabet
+        ]
+        total = sum(weights)
+        assert total > 0, "all weights are 0"
+        quotas = [256 * w / total for w in weights]
+        slots = [int(q) for q in quotas]
+        by_remainder = sorted(range(len(slots)),
+                              key=lambda i: quotas[i] - slots[i],
+                              reverse=True)
+        for i in by_remainder[0:256 - sum(slots)]:
+            slots[i] += 1
+        for i, w in enumerate(weights):
+            while w and not slots[i]:
+                # Take from whoever has the most
+                donor = slots.index(max(slots))
+                slots[donor] -= 1
+                slots[i] += 1
+        table = bytearray()
+        for b, n in zip(self.alphabet, slots):
+            table += bytes([b]) * n
+        return bytes(table)
+
+    def generate(self, pool, n):
+        '''n bytes total, including any prefix / suffix'''
+        prefix = b""
+        suffix = b""
+        if self.prefixes and pool.rng.random() < self.prefix_prob:
+            prefix = pool.rng.choice(self.prefixes)
+        if self.suffixes and pool.rng.random() < self.suffix_prob:
+            suffix = pool.rng.choice(self.suffixes)
+        body = pool.randbytes(max(0, n - len(prefix) - len(suffix)), self)
+        if not prefix and not suffix:
+            return body
+        return prefix + bytes(body) + suffix
+
+
+def repair_table(alphabet, keep=b""):
+    '''
+    bytes.translate() table that keeps alphabet and keep bytes and folds the
+    rest into alphabet
+    '''
+    return bytes(b if b in alphabet or b in keep else alphabet[b % len(alphabet)]
+                 for b in range(256))
+
+
+class CorpusEntry(object):
+    def __init__(self, tx, energy=1.0):
+        self.tx = bytes(tx)
+        self.energy = energy
+        self.uses = 0
+        self.finds = 0
+
+
+class Corpus(object):
+    '''
+    AFL style corpus: inputs that got a new response class are kept and
+    mutated (bit flips, random bytes, insert / delete / duplicate,
+    dictionary tokens, splices with other entries)
+    Entries are picked by energy: an entry whose mutants keep finding new
+    responses gets more turns, one that doesn't slowly fades
+    Draws from pool.rng
+    alphabet: random bytes come from here
+    strict: fold mutants back into alphabet (ex: ByteSpec forbidden bytes)
+    except for keep bytes (ex: ByteSpec prefixes / suffixes, tokens)
+    '''
+    def __init__(self,
+                 pool,
+                 tokens=None,
+                 alphabet=None,
+                 strict=False,
+                 max_len=64,
+                 keep=b""):
+        self.pool = pool
+        self.tokens = [bytes(token) for token in tokens or [] if token]
+        self.alphabet = alphabet
+        self.repair = None
+        if alphabet and strict:
+            self.repair = repair_table(alphabet, keep)
+        self.max_len = max_len
+        self.entries = []
+        self.seen = set()
+
+    def add(self, tx, energy=1.0):
+        tx = bytes(tx)
+        if not tx or tx in self.seen:
+            return None
+        self.seen.add(tx)
+        entry = CorpusEntry(tx, energy)
+        self.entries.append(entry)
+        return entry
+
+    def choose(self):
+        return self.pool.rng.choices(self.entries,
+                              weights=[entry.energy
+                                       for entry in self.entries])[0]
+
+    def randbytes(self, n):
+        return bytes(self.pool.randbytes(n, self.alphabet))
+
+    def mutate_once(self, data):
+        op = self.pool.rng.randrange(8)
+        pos = self.pool.rng.randrange(len(data) + 1)
+        if op == 0 and data:
+            # Bit flip
+            pos = min(pos, len(data) - 1)
+            data[pos] ^= 1 << self.pool.rng.randrange(8)
+        elif op == 1 and data:
+            # Random byte
+            pos = min(pos, len(data) - 1)
+            data[pos:pos + 1] = self.randbytes(1)
+        elif op == 2:
+            data[pos:pos] = self.randbytes(self.pool.rng.randint(1, 4))
+        elif op == 3 and len(data) > 1:
+            del data[pos:pos + self.pool.rng.randint(1, 4)]
+        elif op == 4 and data:
+            # Duplicate a chunk
+            start = self.pool.rng.randrange(len(data))
+            data[pos:pos] = data[start:start + self.pool.rng.randint(1, 8)]
+        elif op == 5 and self.tokens:
+            data[pos:pos] = self.pool.rng.choice(self.tokens)
+        elif op == 6 and self.tokens and data:
+            # Overwrite with a token
+            token = self.pool.rng.choice(self.tokens)
+            data[pos:pos + len(token)] = token
+        elif op == 7 and len(self.entries) > 1:
+            # Splice: our head, someone else's tail
+            other = self.pool.rng.choice(self.entries).tx
+            data[pos:] = other[self.pool.rng.randrange(len(other)):]
+        return data
+
+    def mutate(self):
+        '''Returns (tx, parent entry)'''
+        entry = self.choose()
+        entry.uses += 1
+        # Don't keep hammering on an entry that isn't going anywhere
+        entry.energy = max(0.05, entry.energy * 0.98)
+        data = bytearray(entry.tx)
+        # Havoc: stack a few mutations
+        for _i in range(1 << self.pool.rng.randrange(3)):
+            data = self.mutate_once(data)
+        if not data:
+            data = bytearray(self.randbytes(1))
+        del data[self.max_len:]
+        if self.repair:
+            data = data.translate(self.repair)
+        return bytes(data), entry
+
+    def reward(self, parent, tx, level):
+        '''tx (a mutant of parent, if any) got a new response class'''
+        energy = 2.0 if level == "shape" else 1.0
+        if parent:
+            parent.finds += 1
+            parent.energy += energy
+        return self.add(tx, energy)
+
+
+class RandPool(object):
+    '''
+    Random bytes handed out as zero copy slices of big blocks
+    Constraints are applied with a bytes.translate() table instead of
+    regenerating whole buffers
+    rng: random.Random for reproducible bytes, default os.urandom()
+    Whatever draws alongside the pool (ByteSpec, Corpus) uses .rng too
+    '''
+    def __init__(self, block_size=1 << 16, rng=None):
+        self.block_size = block_size
+        self.rng = rng or random
+        # alphabet => [memoryview, position]
+        self.pools = {}
+        # alphabet => (translate table, delete)
+        self.tables = {}
+
+    def seed(self, rng):
+        '''Draw from rng from now on, dropping anything buffered before'''
+        self.rng = rng
+        self.pools = {}
+
+    def urandom(self, n):
+        if self.rng is random:
+            return os.urandom(n)
+        return self.rng.randbytes(n)
+
+    def table(self, alphabet):
+        ret = self.tables.get(alphabet)
+        if ret is None:
+            if isinstance(alphabet, ByteSpec):
+                ret = alphabet.table()
+            else:
+                ret = alphabet_table(alphabet)
+            self.tables[alphabet] = ret
+        return ret
+
+    def refill(self, n, alphabet):
+        pool = self.pools.get(alphabet)
+        if pool is None and alphabet is None:
+            # Fresh stream: the block is the pool, no copies
+            pool = [memoryview(self.urandom(max(self.block_size, n))), 0]
+            self.pools[alphabet] = pool
+            return pool
+        buf = bytearray()
+        if pool:
+            buf += pool[0][pool[1]:]
+        while len(buf) < n:
+            raw = self.urandom(max(self.block_size, 2 * n))
+            if alphabet is not None:
+                raw = raw.translate(*self.table(alphabet))
+            buf += raw
+        pool = [memoryview(bytes(buf)), 0]
+        self.pools[alphabet] = pool
+        return pool
+
+    def randbytes(self, n, alphabet=None):
+        '''
+        n random bytes, optionally restricted to alphabet
+        (a bytes object or a ByteSpec, which ignores its prefixes / suffixes)
+        Returns a read only memoryview
+        '''
+        pool = self.pools.get(alphabet)
+        if pool is None or len(pool[0]) - pool[1] < n:
+            pool = self.refill(n, alphabet)
+        pos = pool[1]
+        pool[1] = pos + n
+        return pool[0][pos:pos + n]
+
+
+def _byte_class(b):
+    if chr(b).isalpha() and b < 0x80:
+        return b"a"
+    if chr(b).isdigit() and b < 0x80:
+        return b"d"
+    if b in b"\t\r\n":
+        return b"n"
+    if 0x20 <= b < 0x7F:
+        return b"p"
+    if b < 0x80:
+        return b"c"
+    return b"h"
+
+
+# alpha, digit, newline, punctuation, control, high bit
+BYTE_CLASSES = b"".join(_byte_class(b) for b in range(256))
+NOVELTY_LEVELS = ["off", "exact", "norm", "shape"]
+
+
+class NoveltyIndex(object):
+    '''
+    Remembers response signatures (per serial config) so only new device
+    behavior gets fully logged and repeats become counters
+    Levels, most to least novel:
+    -shape: new rx length bucket + byte class run fingerprint (ex: "ad*n*")
+    -norm: new rx once the echo of tx is stripped out
+    -exact: new rx bytes
+    '''
+    def __init__(self):
+        # Hashes only, rx themselves would cost too much on a long run
+        self.exact = collections.Counter()
+        self.shape = set()
+        # norm key => [count, id, first settings, first rx (truncated)]
+        self.norm = {}
+
+    def strip_echo(self, tx, rx):
+        tx = bytes(tx)
+        if not tx:
+            return bytes(rx)
+        return bytes(rx).replace(tx, b"")
+
+    def fingerprint(self, rx):
+        classes = re.sub(rb"(.)\1+", rb"\1*", bytes(rx).translate(BYTE_CLASSES))
+        return (len(rx).bit_length(), classes)
+
+    def check(self, tx, rx, settings):
+        '''
+        Record an exchange
+        Returns (level, norm id): level is a NOVELTY_LEVELS entry or None if seen before
+        '''
+        level = None
+        exact = (settings, hash(bytes(rx)))
+        if not self.exact[exact]:
+            level = "exact"
+        self.exact[exact] += 1
+
+        norm_rx = self.strip_echo(tx, rx)
+        norm = (settings, hash(norm_rx))
+        entry = self.norm.get(norm)
+        if entry is None:
+            level = "norm"
+            entry = [0, len(self.norm) + 1, settings, norm_rx[0:32]]
+            self.norm[norm] = entry
+        entry[0] += 1
+
+        shape = (settings, self.fingerprint(norm_rx))
+        if shape not in self.shape:
+            level = "shape"
+            self.shape.add(shape)
+        return level, entry[1]
+
+    def top(self, n=5):
+        '''Most repeated normalized responses: [(count, id, settings, rx prefix)]'''
+        return sorted(self.norm.values(), key=lambda entry: -entry[0])[0:n]
+
+
+def unmark_parity(rx):
+    '''
+    Undo termios PARMRK escaping
+    Returns (data, number of framing / parity errors)
+    '''
+    if 0xFF not in rx:
+        return bytes(rx), 0
+    ret = bytearray()
+    errors = 0
+    i = 0
+    while i < len(rx):
+        if rx[i] == 0xFF and i + 1 < len(rx):
+            if rx[i + 1] == 0xFF:
+                ret.append(0xFF)
+                i += 2
+                continue
+            if rx[i + 1] == 0x00:
+                # \377 \0 c: c received with an error (\377 \0 \0 is a break)
+                errors += 1
+                i += 3
+                continue
+        ret.append(rx[i])
+        i += 1
+    return bytes(ret), errors
+
+
+def entropy(data):
+    '''Shannon entropy in bits / byte'''
+    if not len(data):
+        return 0.0
+    ret = 0.0
+    for count in collections.Counter(data).values():
+        p = count / len(data)
+        ret -= p * math.log2(p)
+    return ret
+
+
+def autobaud_score(tx, rx, errors=0):
+    '''
+    How much rx looks like it was received at the right line settings
+    None if there was nothing to judge
+    Weighs printable ratio, echo of tx, framing errors and entropy
+    (garbage from a wrong baudrate is noisy)
+    '''
+    if not len(rx) and not errors:
+        return None
+    total = len(rx) + errors
+    printable = (len(rx) - len(rx.translate(None, PRINTABLE))) / total
+    echo = 1.0 if len(tx) and bytes(tx) in rx else 0.0
+    framing = errors / total
+    return (0.35 * printable + 0.25 * echo + 0.2 * (1.0 - framing) + 0.2 *
+            (1.0 - entropy(rx) / 8.0))
+
+
+class RandomScheduler(object):
+    '''Independent random choice every time'''
+    def __init__(self, configs, rng=random):
+        self.configs = list(configs)
+        self.rng = rng
+
+    def next(self):
+        return self.rng.choice(self.configs)
+
+    def update(self, config, reward):
+        pass
+
+    def best(self, n=5):
+        '''Nothing is tracked'''
+        return []
+
+
+class SweepScheduler(object):
+    '''
+    Sweep every config sweeps times (shuffled) so nothing is retested before
+    the whole space is covered, then hand out configs with UCB1 so the budget
+    drifts towards configs that get (printable) responses
+    Rewards are per test case, see rx_score()
+    '''
+    def __init__(self, configs, sweeps=1, explore=0.5, rng=random):
+        self.configs = list(configs)
+        self.explore = explore
+        self.pulls = dict((config, 0) for config in self.configs)
+        self.rewards = dict((config, 0.0) for config in self.configs)
+        self.total = 0
+        self.pending = []
+        for _i in range(sweeps):
+            order = list(self.configs)
+            rng.shuffle(order)
+            self.pending += order
+        # pop() from the end
+        self.pending.reverse()
+
+    def next(self):
+        if self.pending:
+            return self.pending.pop()
+        log_total = math.log(max(self.total, 1))
+
+        def ucb(config):
+            pulls = self.pulls[config]
+            if not pulls:
+                return float("inf")
+            return self.rewards[config] / pulls + self.explore * math.sqrt(
+                2 * log_total / pulls)
+
+        return max(self.configs, key=ucb)
+
+    def update(self, config, reward):
+        self.pulls[config] += 1
+        self.rewards[config] += reward
+        self.total += 1
+
+    def best(self, n=5):
+        '''[(mean reward, pulls, config)] for the top configs'''
+        ret = [(self.rewards[config] / self.pulls[config], self.pulls[config],
+                config) for config in self.configs if self.pulls[config]]
+        ret.sort(key=lambda x: -x[0])
+        return ret[0:n]
+
+
+class StreamRandom(random.Random):
+    '''
+    Counter based random.Random: block i of the (run seed, worker, iteration)
+    stream is blake2b(seed, worker, itr, i), so any stream starts in O(1)
+    without seeding a Mersenne Twister
+    Iteration 0 is the worker's serial config schedule
+    '''
+    def __init__(self, seed, worker, itr):
+        self.key = hashlib.blake2b(struct.pack("<QQQ", seed, worker, itr))
+        self.block = 0
+        self.buf = b""
+        self.pos = 0
+
+    def seed(self, *args, **kwargs):
+        # Keyed in __init__, nothing to (re)seed
+        pass
+
+    def next_block(self):
+        h = self.key.copy()
+        h.update(self.block.to_bytes(8, "little"))
+        self.block += 1
+        self.buf = h.digest()
+        self.pos = 0
+
+    def randbytes(self, n):
+        if self.pos + n <= len(self.buf):
+            self.pos += n
+            return self.buf[self.pos - n:self.pos]
+        ret = [self.buf[self.pos:]]
+        n -= len(ret[0])
+        while n > 0:
+            self.next_block()
+            ret.append(self.buf[0:n])
+            self.pos = len(ret[-1])
+            n -= self.pos
+        return b"".join(ret)
+
+    def getrandbits(self, k):
+        return int.from_bytes(self.randbytes((k + 7) // 8), "little") >> (-k % 8)
+
+    def _randbelow(self, n):
+        # random.Random's rejection loop, minus a layer of calls per try
+        k = n.bit_length()
+        nbytes = (k + 7) // 8
+        shift = -k % 8
+        r = int.from_bytes(self.randbytes(nbytes), "little") >> shift
+        while r >= n:
+            r = int.from_bytes(self.randbytes(nbytes), "little") >> shift
+        return r
+
+    def random(self):
+        return (int.from_bytes(self.randbytes(7), "little") >> 3) * (1.0 / (1 << 53))
+
+
+def new_seed():
+    return int.from_bytes(os.urandom(8), "little")
+
+
 def add_bool_arg(parser, yes_arg, default=False, **kwargs):
     dashed = yes_arg.replace('--', '')
     dest = dashed.replace('-', '_')
@@ -26,20 +662,115 @@ def add_bool_arg(parser, yes_arg, default=False, **kwargs):
     parser.add_argument(
         '--no-' + dashed, dest=dest, action='store_false', **kwargs)
 
+# Byte => its escape / C literal, reproducers are joined from these
+ANON_HEX = ["\\x%02X" % b for b in range(256)]
+C_HEX = ["0x%02X" % b for b in range(256)]
+
+
 def bytes2AnonArray(bytes_data):
-    byte_str = "b\""
+    rows = [
+        'b"%s"' % ''.join(map(ANON_HEX.__getitem__, bytes_data[i:i + 16]))
+        for i in range(0, len(bytes_data), 16)
+    ]
+    return "\n            ".join(rows) or 'b""'
+
+
+def bytes2CArray(bytes_data, name):
+    rows = [
+        ", ".join(map(C_HEX.__getitem__, bytes_data[i:i + 12]))
+        for i in range(0, len(bytes_data), 12)
+    ]
+    if not rows:
+        return "uint8_t %s[] = {};" % name
+    return "uint8_t %s[%u] = {\n    %s\n};" % (name, len(bytes_data),
+                                             ",\n    ".join(rows))
+
+
+def repro_txrx(tx, rx):
+    return "# rx = %s\nsf.txrx(%s)" % (bytes2AnonArray(rx), bytes2AnonArray(tx))
+
+
+def repro_python(tx, rx):
+    # Parenthesized so continuation rows are valid Python
+    return "tx = (%s)\nrx = (%s)" % (
+        bytes2AnonArray(tx).replace("\n            ", "\n      "),
+        bytes2AnonArray(rx).replace("\n            ", "\n      "))
+
+
+def repro_c(tx, rx):
+    return "%s\n%s" % (bytes2CArray(tx, "tx"), bytes2CArray(rx, "rx"))
+
+
+def repro_hex(tx, rx):
+    return "tx %s\nrx %s" % (tx.hex().upper(), rx.hex().upper())
+
+
+# How a logged case is printed for copy / paste, see --repro
+REPRO_FORMATS = collections.OrderedDict([
+    ("txrx", repro_txrx),
+    ("python", repro_python),
+    ("c", repro_c),
+    ("hex", repro_hex),
+])
+
+
+class ReproScript(object):
+    '''
+    Runnable script sending every logged case again: ./repro.py [port]
+    Cases are held until flush(), every print_interval cases and at exit
+    '''
+    def __init__(self, fn, port=None):
+        self.f = open(fn, 'w')
+        os.chmod(fn, 0o755)
+        self.settings = None
+        self.pending = [
+            "#!/usr/bin/env python3\n"
+            "# Logged cases of an sfuzz run, ex: %s %s\n"
+            "import sys\n"
+            "sys.path.insert(0, %r)\n"
+            "from main import SFuzz\n"
+            "sf = SFuzz(port=sys.argv[1] if len(sys.argv) > 1 else %r)\n" %
+            (os.path.basename(fn), port or "/dev/ttyUSB0",
+             os.path.dirname(os.path.abspath(__file__)), port)
+        ]
+        atexit.register(self.close)
+
+    def case(self, tx, rx, settings):
+        if settings != self.settings:
+            self.settings = settings
+            self.pending.append("\nsf.mkser(%s)\n" % ", ".join(
+                "%s=%r" % item for item in settings._asdict().items()))
+        self.pending.append(
+            "# rx = %s\nsf.txrx(%s, verbose=True)\n" %
+            (bytes2AnonArray(rx).replace("\n", "\n# "), bytes2AnonArray(tx)))
+
+    def flush(self):
+        if self.pending and not self.f.closed:
+            self.f.write("".join(self.pending))
+            self.f.flush()
+        self.pending = []
 
-    for i in range(len(bytes_data)):
-        if i and i % 16 == 0:
-            byte_str += "\"\n            b\""
-        byte_str += "\\x%02X" % (bytes_data[i], )
-    return byte_str + "\""
+    def close(self):
+        self.flush()
+        self.f.close()
 
 # Print timestamps in front of all output messages
 class IOTimestamp(object):
-    def __init__(self, obj=sys, name='stdout'):
+    '''
+    mode
+    -utc: wall clock ISO 8601
+    -mono: ISO 8601 from the monotonic clock + its offset at start (no NTP jumps)
+    -ns: raw time.monotonic_ns()
+    The formatted prefix is cached and only rebuilt once per resolution seconds
+    '''
+    def __init__(self, obj=sys, name='stdout', mode='utc', resolution=0.001):
         self.obj = obj
         self.name = name
+        self.mode = mode
+        self.resolution_ns = max(1, int(resolution * 1e9))
+        self.mono_offset_ns = time.time_ns() - time.monotonic_ns()
+        self.tick = None
+        self.prefix = None
 
         self.fd = obj.__dict__[name]
         obj.__dict__[name] = self
@@ -52,20 +783,125 @@ class IOTimestamp(object):
     def flush(self):
         self.fd.flush()
 
+    def stamp(self):
+        if self.mode == 'utc':
+            now = time.time_ns()
+        else:
+            now = time.monotonic_ns()
+        tick = now // self.resolution_ns
+        if tick != self.tick:
+            self.tick = tick
+            now = tick * self.resolution_ns
+            if self.mode == 'ns':
+                stamp = str(now)
+            else:
+                if self.mode == 'mono':
+                    now += self.mono_offset_ns
+                stamp = datetime.datetime.fromtimestamp(
+                    now / 1e9, datetime.timezone.utc).replace(
+                        tzinfo=None).isoformat()
+            self.prefix = '%s: ' % stamp
+        return self.prefix
+
     def write(self, data):
-        parts = data.split('\n')
-        for i, part in enumerate(parts):
-            if i != 0:
-                self.fd.write('\n')
-            # If last bit of text is just an empty line don't append date until text is actually written
-            if i == len(parts) - 1 and len(part) == 0:
-                break
-            if self.nl:
-                self.fd.write('%s: ' % datetime.datetime.utcnow().isoformat())
-            self.fd.write(part)
-            # Newline results in n + 1 list elements
-            # The last element has no newline
-            self.nl = i != (len(parts) - 1)
+        if not data:
+            return
+        if not self.nl and '\n' not in data:
+            self.fd.write(data)
+            return
+        prefix = self.stamp()
+        # Don't stamp a trailing newline until text actually follows
+        nl = data.endswith('\n')
+        if nl:
+            data = data[:-1].replace('\n', '\n' + prefix) + '\n'
+        else:
+            data = data.replace('\n', '\n' + prefix)
+        if self.nl:
+            data = prefix + data
+        self.fd.write(data)
+        self.nl = nl
+
+
+class BufferedSink(object):
+    '''
+    Collects writes in memory, a background thread writes them out once size
+    chars are pending or every interval seconds
+    Each write names its destination files so a shared log keeps stdout and
+    stderr in order
+    Flushed at exit, including ^C and SIGTERM (see flush_on_term())
+    '''
+    def __init__(self, size=1 << 16, interval=0.2):
+        self.size = size
+        self.interval = interval
+        # [(destination files, data)]
+        self.buf = []
+        self.pending = 0
+        self.lock = threading.Lock()
+        # Keeps a flush from the thread and one from atexit in order
+        self.flush_lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def write(self, data, dsts):
+        with self.lock:
+            self.buf.append((dsts, data))
+            self.pending += len(data)
+            if self.pending >= self.size:
+                self.wake.set()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                buf = self.buf
+                self.buf = []
+                self.pending = 0
+            # Coalesce runs going to the same place into one write
+            flushes = []
+            i = 0
+            while i < len(buf):
+                dsts = buf[i][0]
+                j = i
+                while j < len(buf) and buf[j][0] is dsts:
+                    j += 1
+                data = ''.join(data for _dsts, data in buf[i:j])
+                for dst in dsts:
+                    dst.write(data)
+                    if dst not in flushes:
+                        flushes.append(dst)
+                i = j
+            for dst in flushes:
+                dst.flush()
+
+    def loop(self):
+        while True:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            self.flush()
+
+
+def flush_on_term():
+    '''Turn SIGTERM into a normal exit so atexit / finally flushes still run'''
+    def handler(signum, frame):
+        raise SystemExit(128 + signum)
+
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, handler)
+
+
+class BufferedWriter(object):
+    '''File like front end to a BufferedSink'''
+    def __init__(self, sink, dsts):
+        self.sink = sink
+        self.dsts = tuple(dsts)
+
+    def write(self, data):
+        self.sink.write(data, self.dsts)
+
+    def flush(self):
+        # The sink decides when to hit the disk
+        pass
 
 
 # Log file descriptor to file
@@ -77,7 +913,8 @@ class IOLog(object):
                  out_fd=None,
                  mode='a',
                  shift=False,
-                 multi=False):
+                 multi=False,
+                 sink=None):
         if not multi:
             if out_fd:
                 self.out_fd = out_fd
@@ -109,17 +946,24 @@ class IOLog(object):
         self.fd = obj.__dict__[name]
         obj.__dict__[name] = self
         self.nl = True
+        # Optional BufferedSink batching writes to both
+        self.sink = sink
+        self.dsts = (self.fd, self.out_fd)
 
     def __del__(self):
         if self.obj:
             self.obj.__dict__[self.name] = self.fd
 
     def flush(self):
-        self.fd.flush()
+        if not self.sink:
+            self.fd.flush()
 
     def write(self, data):
-        self.fd.write(data)
-        self.out_fd.write(data)
+        if self.sink:
+            self.sink.write(data, self.dsts)
+        else:
+            self.fd.write(data)
+            self.out_fd.write(data)
 
 
 def try_shift_dir(d):
@@ -135,46 +979,65 @@ def try_shift_dir(d):
         break
 
 
-def logwt(d, fn, shift_d=True, shift_f=False, stampout=True):
+def logwt(d,
+          fn,
+          shift_d=True,
+          shift_f=False,
+          stampout=True,
+          buffered=False,
+          stamp_mode='utc',
+          stamp_resolution=0.001):
     '''Log with timestamping'''
 
     if shift_d:
         try_shift_dir(d)
         os.mkdir(d)
 
+    sink = None
+    if buffered:
+        sink = BufferedSink()
+        flush_on_term()
     fn_can = os.path.join(d, fn)
-    outlog = IOLog(obj=sys, name='stdout', out_fn=fn_can, shift=shift_f)
-    errlog = IOLog(obj=sys, name='stderr', out_fd=outlog.out_fd)
+    outlog = IOLog(obj=sys, name='stdout', out_fn=fn_can, shift=shift_f, sink=sink)
+    errlog = IOLog(obj=sys, name='stderr', out_fd=outlog.out_fd, sink=sink)
 
     # Add stamps after so that they appear in output logs
     outdate = None
     errdate = None
     if stampout:
-        outdate = IOTimestamp(sys, 'stdout')
-        errdate = IOTimestamp(sys, 'stderr')
+        outdate = IOTimestamp(sys, 'stdout', stamp_mode, stamp_resolution)
+        errdate = IOTimestamp(sys, 'stderr', stamp_mode, stamp_resolution)
 
     return (outlog, errlog, outdate, errdate)
 
 
-def default_port():
-    '''Try to guess the serial port, if we can find a reasonable guess'''
+def serial_ports():
+    '''USB serial ports attached to this machine'''
     if platform.system() == "Linux":
-        serials = glob.glob("/dev/ttyUSB*") + glob.glob("/dev/ttyACM*")
-        if len(serials) == 0:
-            raise Exception("Could not detect any serial ports")
-        elif len(serials) == 1:
-            return serials[0]
-        else:
-            raise Exception("Multiple serial ports, please specify which")
+        return sorted(glob.glob("/dev/ttyUSB*") + glob.glob("/dev/ttyACM*"))
     else:
         return None
 
 
+def default_port():
+    '''Try to guess the serial port, if we can find a reasonable guess'''
+    serials = serial_ports()
+    if serials is None:
+        return None
+    if len(serials) == 0:
+        raise Exception("Could not detect any serial ports")
+    elif len(serials) == 1:
+        return serials[0]
+    else:
+        raise Exception("Multiple serial ports, please specify which (or --port all)")
+
+
+# latin-1 maps code points 0-255 to the byte of the same value: the same
+# as ord() / chr() per byte, but one codec call
 def tobytes(buff):
     if type(buff) is str:
-        #return bytearray(buff, 'ascii')
-        return bytearray([ord(c) for c in buff])
-    elif type(buff) is bytearray or type(buff) is bytes:
+        return buff.encode('latin-1')
+    elif type(buff) in (bytearray, bytes, memoryview):
         return buff
     else:
         assert 0, type(buff)
@@ -183,8 +1046,8 @@ def tobytes(buff):
 def tostr(buff):
     if type(buff) is str:
         return buff
-    elif type(buff) is bytearray or type(buff) is bytes:
-        return ''.join([chr(b) for b in buff])
+    elif type(buff) in (bytearray, bytes, memoryview):
+        return str(buff, 'latin-1')
     else:
         assert 0, type(buff)
 
@@ -208,47 +1071,177 @@ def default_date_dir(root, prefix, postfix):
         n += 1
 
 
-def hexdump(data, label=None, indent='', address_width=8, f=sys.stdout):
-    def isprint(c):
-        return c >= ' ' and c <= '~'
+# Byte => itself if printable ASCII else '.', for bytes.translate()
+HEXDUMP_CHARS = bytes(c if 0x20 <= c <= 0x7E else 0x2E for c in range(256))
+HEXDUMP_ROW = 16
+# Rows formatted per write, bounds the buffer for multi MB dumps
+HEXDUMP_BLOCK = 4096 * HEXDUMP_ROW
+
+
+def hexdump_rows(data, pos=0, indent='', address_width=8):
+    '''
+    hexdump() text of data as a string, addresses starting at pos
+    Rows are formatted from a whole buffer .hex() and .translate() instead
+    of per byte
+    '''
+    if not isinstance(data, (bytes, bytearray)):
+        data = bytes(data)
+    # "XX " per byte, 8 bytes to a 24 char half row
+    hexs = data.hex(' ').upper() + ' '
+    chars = data.translate(HEXDUMP_CHARS).decode('ascii')
+    fmt = indent.replace('%', '%%')
+    if address_width:
+        fmt += '%%0%dX  ' % address_width
+    fmt += '%s %s |%s|\n'
+    full = len(data) - len(data) % HEXDUMP_ROW
+    if address_width:
+        ret = [
+            fmt % (pos + i, hexs[i * 3:i * 3 + 24], hexs[i * 3 + 24:i * 3 + 48],
+                   chars[i:i + HEXDUMP_ROW])
+            for i in range(0, full, HEXDUMP_ROW)
+        ]
+    else:
+        ret = [
+            fmt % (hexs[i * 3:i * 3 + 24], hexs[i * 3 + 24:i * 3 + 48],
+                   chars[i:i + HEXDUMP_ROW])
+            for i in range(0, full, HEXDUMP_ROW)
+        ]
+    if full < len(data):
+        # Partial last row, pad out to the char view
+        row = (hexs[full * 3:full * 3 + 24].ljust(24),
+               hexs[full * 3 + 24:full * 3 + 48].ljust(24),
+               chars[full:].ljust(HEXDUMP_ROW))
+        ret.append(fmt % (((pos + full), ) + row if address_width else row))
+    return ''.join(ret)
+
+
+def hexdump(data, label=None, indent='', address_width=8, f=None):
+    # Resolve late so redirected / logged stdout is honored
+    if f is None:
+        f = sys.stdout
 
     if label:
         print(label)
 
-    bytes_per_half_row = 8
-    bytes_per_row = 16
-    data = bytearray(data)
-    data_len = len(data)
+    data = memoryview(data).cast('B') if not isinstance(
+        data, (bytes, bytearray)) else data
+    for pos in range(0, len(data), HEXDUMP_BLOCK):
+        f.write(
+            hexdump_rows(data[pos:pos + HEXDUMP_BLOCK], pos, indent,
+                         address_width))
+
+
+class HexdumpStream(object):
+    '''
+    hexdump() of data that shows up a piece at a time (ex: a multi MB rx)
+    Complete rows are written as they're known, close() writes the last one
+    Same output as one hexdump() of everything written
+    '''
+    def __init__(self, f=None, indent='', address_width=8):
+        self.f = f
+        self.indent = indent
+        self.address_width = address_width
+        self.buf = bytearray()
+        self.pos = 0
 
-    def hexdump_half_row(start):
-        left = max(data_len - start, 0)
+    def write(self, data):
+        self.buf += data
+        n = len(self.buf) - len(self.buf) % HEXDUMP_ROW
+        if n:
+            self.flush_rows(n)
 
-        real_data = min(bytes_per_half_row, left)
+    def flush_rows(self, n):
+        for start in range(0, n, HEXDUMP_BLOCK):
+            end = min(n, start + HEXDUMP_BLOCK)
+            (self.f or sys.stdout).write(
+                hexdump_rows(self.buf[start:end], self.pos + start,
+                             self.indent, self.address_width))
+        del self.buf[0:n]
+        self.pos += n
 
-        f.write(''.join('%02X ' % c for c in data[start:start + real_data]))
-        f.write(''.join('   ' * (bytes_per_half_row - real_data)))
-        f.write(' ')
+    def close(self):
+        if self.buf:
+            self.flush_rows(len(self.buf))
 
-        return start + bytes_per_half_row
 
-    pos = 0
-    while pos < data_len:
-        row_start = pos
-        f.write(indent)
-        if address_width:
-            f.write(('%%0%dX  ' % address_width) % pos)
-        pos = hexdump_half_row(pos)
-        pos = hexdump_half_row(pos)
-        f.write("|")
-        # Char view
-        left = data_len - row_start
-        real_data = min(bytes_per_row, left)
+def parse_escapes(s):
+    '''Decode backslash escapes given on the command line (ex: *VN\\r)'''
+    return codecs.escape_decode(s.encode('latin-1'))[0]
 
-        f.write(''.join([
-            c if isprint(c) else '.'
-            for c in tostr(data[row_start:row_start + real_data])
-        ]))
-        f.write((" " * (bytes_per_row - real_data)) + "|\n")
+
+def char_time(baudrate,
+              bytesize=serial.EIGHTBITS,
+              parity=serial.PARITY_NONE,
+              stopbits=serial.STOPBITS_ONE):
+    '''Seconds to shift one character onto the wire'''
+    bits = 1 + bytesize + stopbits
+    if parity != serial.PARITY_NONE:
+        bits += 1
+    return bits / float(baudrate)
+
+
+# Seconds an adapter may sit on rx before handing it over
+# FTDI style latency_timer defaults to 16 ms, UART FIFOs hold a few chars
+ADAPTER_LATENCY = 0.02
+# Same with --low-latency (latency_timer 1 ms)
+LOW_LATENCY = 0.002
+# Default listen between batched cases, in character times
+# Late rx is sorted out by rx_latency_ns and bisection, not by waiting
+BATCH_GUARD_CHARS = 2
+
+
+class RxCompletion(object):
+    '''
+    Decides when a response is over
+    Whichever comes first:
+    -nothing received within timeout
+      (default: latency + timeout_chars character times)
+    -line idle for gap_chars character times after a byte (or gap seconds if given)
+      never less than latency: rx arrives in bursts that far apart
+    -terminator received
+    -length bytes received
+    -max_size bytes received
+    '''
+    def __init__(self,
+                 timeout=None,
+                 gap_chars=4,
+                 gap=None,
+                 min_gap=0.002,
+                 terminator=None,
+                 length=None,
+                 max_size=1024,
+                 latency=ADAPTER_LATENCY,
+                 timeout_chars=10):
+        self.timeout = timeout
+        self.gap_chars = gap_chars
+        self.gap = gap
+        # Don't cut a response on scheduling jitter
+        self.min_gap = min_gap
+        self.terminator = terminator
+        self.length = length
+        self.max_size = max_size
+        self.latency = latency
+        self.timeout_chars = timeout_chars
+
+    def first(self, char_s):
+        '''Seconds to wait for the first byte'''
+        if self.timeout is not None:
+            return self.timeout
+        return self.latency + self.timeout_chars * char_s
+
+    def idle(self, char_s):
+        if self.gap is not None:
+            return self.gap
+        return max(self.gap_chars * char_s, self.min_gap, self.latency)
+
+    def done(self, rx):
+        if len(rx) >= self.max_size:
+            return True
+        if self.length is not None and len(rx) >= self.length:
+            return True
+        if self.terminator and self.terminator in rx:
+            return True
+        return False
 
 
 def mkdir_p(path):
@@ -262,9 +1255,58 @@ def mkdir_p(path):
 
 
 class SFuzz:
-    def __init__(self, port=None, baudrates=None, ascii=False, parities=None, stopbitss=None, verbose=None):
+    def __init__(self,
+                 port=None,
+                 baudrates=None,
+                 ascii=False,
+                 parities=None,
+                 stopbitss=None,
+                 verbose=None,
+                 completion=None,
+                 configs=None,
+                 persistent=True,
+                 reset=False,
+                 schedule="sweep",
+                 sweeps=1,
+                 bytespec=None,
+                 novelty="norm",
+                 mutate=False,
+                 tokens=None,
+                 capture=None,
+                 seed=None,
+                 worker=0,
+                 capture_silent=True,
+                 batch=1,
+                 guard=None,
+                 bisect=True,
+                 low_latency=False,
+                 transport=None,
+                 repro=None,
+                 repro_script=None,
+                 grammar=None,
+                 grammar_mode="sample"):
         self.verbose = verbose
         self.ser = None
+        # Keep the port open and reconfigure it in place
+        # Reopening toggles DTR/RTS which resets many targets
+        self.persistent = persistent
+        # Explicitly pulse DTR/RTS after every reconfiguration
+        self.reset = reset
+        # Ask the driver / adapter to hand over rx right away, see set_low_latency()
+        self.low_latency = low_latency
+        # Port fd for write(), None if the transport has none
+        self.ser_fd = None
+        # Opens the port, default serial.Serial. ex: sim.EchoDevice().open
+        self.transport = transport
+        # Exchange timing clock, transports in simulated time bring their own
+        self.clock = time.monotonic_ns
+        # REPRO_FORMATS printed for each logged case
+        self.repro = repro or ["txrx"]
+        self.repro_script = repro_script
+        self.completion = completion
+        if self.completion is None:
+            self.completion = RxCompletion(
+                latency=LOW_LATENCY if low_latency else ADAPTER_LATENCY)
 
         self.port = port
         if self.port is None:
@@ -280,16 +1322,27 @@ class SFuzz:
         self.xonxoffs = [False]
         self.ascii = ascii
         self.ascii_newlines = ["\r", "\n", "\r\n"]
-
-        self.baudrates = [9600, 19200, 38400, 115200]
-        self.parities = [
-                    serial.PARITY_NONE, serial.PARITY_EVEN, serial.PARITY_ODD,
-                    serial.PARITY_MARK, serial.PARITY_SPACE
-                ]
-        self.stopbitss = [
-                    serial.STOPBITS_ONE, serial.STOPBITS_ONE_POINT_FIVE,
-                    serial.STOPBITS_TWO
-                ]
+        # Every iteration draws from its own stream: StreamRandom(seed, worker, itr)
+        # so any tx can be regenerated without replaying the run, see regen()
+        self.seed = seed
+        if self.seed is None:
+            self.seed = new_seed()
+        self.worker = worker
+        self.rng = StreamRandom(self.seed, self.worker, 0)
+        # Reseeded every iteration, one keystream block covers most tx
+        self.rand = RandPool(block_size=64, rng=self.rng)
+        # ByteSpec constraining generated payloads, overrides ascii
+        self.bytespec = bytespec
+
+        self.baudrates = list(BAUDRATES)
+        self.parities = list(PARITIES)
+        self.stopbitss = list(STOPBITSS)
+        # Explicit SerConfig list, overrides the above
+        self.configs = configs
+        # "sweep" or "random"
+        self.schedule = schedule
+        self.sweeps = sweeps
+        self.scheduler = None
 
         if baudrates is not None:
             self.baudrates = baudrates
@@ -300,15 +1353,111 @@ class SFuzz:
         if stopbitss is not None:
             self.stopbitss = stopbitss
 
+        self.ser_settings = None
+        self.open_interval = 10
+        self.print_interval = 80
+        # Called as hook(itr, tx, rx, settings) after every exchange
+        self.result_hooks = []
+        # Only fully log responses at least this novel, see NOVELTY_LEVELS
+        self.novelty = novelty
+        self.novelty_index = NoveltyIndex()
+        self.repeats = 0
+        # Coverage guided: mutate inputs that found new responses
+        self.mutate = mutate
+        self.mutate_prob = 0.9
+        # Dictionary for mutations (ex: known command words)
+        self.tokens = list(tokens or [])
+        # Generate commands from a Grammar instead of random bytes
+        # sample: random expansions, enumerate: expansion itr - 1 in order
+        self.grammar = grammar
+        self.grammar_mode = grammar_mode
+        if grammar:
+            self.tokens += grammar.tokens()
+        self.corpus = None
+        # itr => corpus entry the case was mutated from
+        self.parents = {}
+        # CaptureWriter recording every exchange
+        self.capture = capture
+        # Silent generated cases can be left out, regen() brings them back
+        self.capture_silent = capture_silent
+        # Last next_case() drew a mutation
+        self.mutant = False
+        self.tx_ns = 0
+        self.tx_done_ns = 0
+        self.rx_first_ns = None
+        self.rx_last_ns = None
+        # (monotonic ns, bytes) of every chunk of the last response
+        self.rx_chunks = []
+        # Send this many cases back to back, each followed by guard seconds
+        # of listening (default: BATCH_GUARD_CHARS character times)
+        self.batch = batch
+        self.guard = guard
+        # Confirm responses to batches with single exchanges, see bisect_batch()
+        # Otherwise trust rx arrival times to say which case it belongs to
+        self.bisect = bisect
+        # Fastest response seen to a lone case, shifts batch attribution
+        self.rx_latency_ns = None
+        self.batches = 0
+        self.batches_answered = 0
+        self.resent = 0
+
     def flushInput(self, timeout=0.1, max_size=1024):
         # Try to get rid of previous command in progress, if any
-        tlast = time.time()
+        return self.read_response(
+            RxCompletion(timeout=timeout, gap=timeout, max_size=max_size))
+
+    def char_time(self):
+        return char_time(self.ser.baudrate, self.ser.bytesize,
+                         self.ser.parity, self.ser.stopbits)
+
+    def read_response(self, completion=None):
+        '''Read until completion decides the response is over'''
+        if completion is None:
+            completion = self.completion
+        if hasattr(self.ser, "read_response"):
+            # Simulated transport: skip the polling, it keeps its own time
+            ret, self.rx_chunks = self.ser.read_response(
+                completion, completion.first(self.char_time()),
+                completion.idle(self.char_time()))
+            self.rx_first_ns = self.rx_chunks[0][0] if self.rx_chunks else None
+            self.rx_last_ns = self.rx_chunks[-1][0] if self.rx_chunks else None
+            return ret
+        try:
+            fd = self.ser.fileno()
+        except (AttributeError, NotImplementedError):
+            # No pollable fd (ex: Windows), fall back to timed reads
+            fd = None
+        idle = completion.idle(self.char_time())
         ret = bytearray()
-        while time.time() - tlast < timeout and len(ret) < max_size:
-            buf = self.ser.read(max_size)
+        self.rx_first_ns = None
+        self.rx_last_ns = None
+        self.rx_chunks = []
+        deadline = time.monotonic() + completion.first(self.char_time())
+        while not completion.done(ret):
+            wait = deadline - time.monotonic()
+            if wait <= 0:
+                break
+            if fd is None:
+                buf = self.ser.read(
+                    max(1, min(self.ser.in_waiting,
+                               completion.max_size - len(ret))))
+            else:
+                readable, _w, _x = select.select([fd], [], [], wait)
+                if not readable:
+                    break
+                buf = os.read(fd, completion.max_size - len(ret))
+                if not buf:
+                    raise serial.SerialException(
+                        "device reports readiness to read but returned no data"
+                    )
             if buf:
                 ret += buf
-                tlast = time.time()
+                now = time.monotonic_ns()
+                if self.rx_first_ns is None:
+                    self.rx_first_ns = now
+                self.rx_last_ns = now
+                self.rx_chunks.append((now, len(buf)))
+                deadline = now / 1e9 + idle
         return ret
 
     def readline(self, timeout=3.0):
@@ -333,50 +1482,115 @@ class SFuzz:
               rtscts=False,
               dsrdtr=False,
               xonxoff=False):
-        if self.ser:
-            self.ser.close()
-            self.ser = None
-        self.ser = serial.Serial(self.port,
-                                 baudrate=baudrate,
-                                 bytesize=bytesize,
-                                 parity=parity,
-                                 stopbits=stopbits,
-                                 rtscts=rtscts,
-                                 dsrdtr=dsrdtr,
-                                 xonxoff=xonxoff,
-                                 timeout=0.01,
-                                 writeTimeout=0)
-
+        settings = dict(baudrate=baudrate,
+                        bytesize=bytesize,
+                        parity=parity,
+                        stopbits=stopbits,
+                        rtscts=rtscts,
+                        dsrdtr=dsrdtr,
+                        xonxoff=xonxoff)
+        if self.persistent and self.ser and self.ser.is_open:
+            # Only changed settings are pushed, a tcsetattr() each
+            self.ser.apply_settings(settings)
+            # Anything pending was received at the old settings
+            self.ser.reset_input_buffer()
+        else:
+            if self.ser:
+                self.ser.close()
+                self.ser = None
+            self.ser = (self.transport or serial.Serial)(self.port,
+                                                         timeout=0.01,
+                                                         writeTimeout=0,
+                                                         **settings)
+            self.clock = getattr(self.ser, "monotonic_ns", time.monotonic_ns)
+            try:
+                self.ser_fd = self.ser.fileno()
+            except (AttributeError, NotImplementedError):
+                self.ser_fd = None
+            if self.low_latency:
+                self.set_low_latency()
+            self.flushInput()
+        if self.reset:
+            self.reset_device()
+
+    def set_low_latency(self):
+        '''
+        ASYNC_LOW_LATENCY: the driver passes rx up as it comes instead of
+        batching it. FTDI style adapters also hold rx for latency_timer ms
+        (default 16) before a USB transfer, drop that to 1
+        Otherwise rx timestamps mostly measure the adapter
+        '''
+        try:
+            self.ser.set_low_latency_mode(True)
+        except (ValueError, NotImplementedError, AttributeError) as e:
+            print("low latency: %s" % e)
+        fn = "/sys/bus/usb-serial/devices/%s/latency_timer" % os.path.basename(
+            os.path.realpath(self.port))
+        if os.path.exists(fn):
+            try:
+                with open(fn, "w") as f:
+                    f.write("1")
+            except OSError as e:
+                print("low latency: %s" % e)
+
+    def reset_device(self, pulse=0.1):
+        '''Pulse DTR/RTS low like a port reopen does, then drain any banner'''
+        self.verbose and print("reset device")
+        self.ser.dtr = False
+        self.ser.rts = False
+        time.sleep(pulse)
+        self.ser.dtr = True
+        self.ser.rts = True
         self.flushInput()
 
-
     def get_tx(self, chunk_size):
-        def rand_ascii(n):
-            return ''.join(
-                random.choice(string.ascii_uppercase + string.digits)
-                for _ in range(n))
-
+        if self.grammar:
+            if self.grammar_mode == "enumerate":
+                return self.grammar.nth((self.itr - 1) % self.grammar.count())
+            return self.grammar.sample(self.rng)
+        if self.bytespec:
+            return self.bytespec.generate(self.rand, chunk_size)
         if self.ascii:
             if self.ascii_newlines:
-                newline = random.choice(self.ascii_newlines)
-                ret = rand_ascii(chunk_size - len(newline)) + newline
+                newline = self.rng.choice(self.ascii_newlines)
+                return b"".join((self.rand.randbytes(
+                    max(0, chunk_size - len(newline)),
+                    ASCII_ALPHABET), tobytes(newline)))
             else:
-                ret = rand_ascii(chunk_size)
-            return tobytes(ret)
+                return self.rand.randbytes(chunk_size, ASCII_ALPHABET)
         else:
-            return bytearray(
-                [random.randint(0, 255) for _i in range(chunk_size)])
+            return self.rand.randbytes(chunk_size)
+
+    def write(self, tx):
+        '''
+        ser.write() without the copy: pyserial turns every payload into bytes
+        first, os.write() takes the memoryview / bytearray as is
+        The port is non blocking, wait for room instead of dropping the rest
+        '''
+        if self.ser_fd is None:
+            self.ser.write(tx)
+            return
+        tx = memoryview(tx)
+        while tx:
+            try:
+                n = os.write(self.ser_fd, tx)
+            except BlockingIOError:
+                select.select([], [self.ser_fd], [], None)
+                continue
+            tx = tx[n:]
 
     def txrx(self, tx, verbose=False):
-        self.ser.write(tx)
+        self.tx_ns = time.time_ns()
+        self.write(tx)
         # print("flushing")
         # 1) this takes a long time
         # 2) takes a long time after a few passes
         # implies poor implementation not actually flushing :(
         self.verbose and print("flush tx")
         self.ser.flush()
+        self.tx_done_ns = self.clock()
         self.verbose and print("flush rx")
-        rx = self.flushInput()
+        rx = self.read_response()
         if verbose:
             hexdump(tx, label="tx %u" % len(tx))
             hexdump(rx, label="rx %u" % len(rx))
@@ -384,79 +1598,673 @@ class SFuzz:
             # print("sf.txrx(%s)" % bytes2AnonArray(tx))
         return rx
 
-    def ser_init(self):
-        baudrate = random.choice(self.baudrates)
-        parity = random.choice(self.parities)
-        stopbits = random.choice(self.stopbitss)
+    def txrx_batch(self, txs):
+        '''
+        Send txs back to back, listening for guard seconds after each
+        Every rx chunk goes to the last case sent at least rx_latency_ns
+        before it arrived
+        Returns [(rx, rx_times() of each case)]
+        '''
+        guard = self.guard
+        if guard is None:
+            guard = BATCH_GUARD_CHARS * self.char_time()
+        window = RxCompletion(timeout=guard,
+                              gap=guard,
+                              max_size=self.completion.max_size,
+                              latency=0)
+        tx_nss = []
+        done_nss = []
+        # (monotonic ns, data)
+        chunks = []
+        for i, tx in enumerate(txs):
+            tx_nss.append(time.time_ns())
+            self.write(tx)
+            self.ser.flush()
+            self.tx_done_ns = self.clock()
+            done_nss.append(self.tx_done_ns)
+            # Last one gets the full response window
+            rx = self.read_response(
+                self.completion if i == len(txs) - 1 else window)
+            pos = 0
+            for ns, n in self.rx_chunks:
+                chunks.append((ns, rx[pos:pos + n]))
+                pos += n
+        if len(txs) == 1 and chunks:
+            latency = chunks[0][0] - done_nss[0]
+            if self.rx_latency_ns is None or latency < self.rx_latency_ns:
+                self.rx_latency_ns = latency
+        rxs = [bytearray() for _tx in txs]
+        profiles = [[] for _tx in txs]
+        for ns, data in chunks:
+            i = max(0, bisect.bisect_right(
+                done_nss, ns - (self.rx_latency_ns or 0)) - 1)
+            rxs[i] += data
+            profiles[i].append((ns - done_nss[i], len(data)))
+        self.verbose and chunks and print(
+            "batch of %u: rx in %u chunks for cases %s" %
+            (len(txs), len(chunks),
+             [i for i, rx in enumerate(rxs) if rx]))
+        return [(rx, (tx_ns, profile[0][0] if profile else 0,
+                      profile[-1][0] if profile else 0, profile))
+                for rx, tx_ns, profile in zip(rxs, tx_nss, profiles)]
+
+    def bisect_batch(self, txs, results):
+        '''
+        Pin the responses of a batch (results: its txrx_batch()) on cases
+        Cases after the last one that got rx were silent: a response can't
+        come before its tx
+        Usually a response belongs to the case it arrived after: resend each
+        of those alone, then the other suspects as one batch, narrowing that
+        down the same way if it gets a response
+        Note the target sees those cases again
+        '''
+        last = max(i for i, (rx, _times) in enumerate(results) if len(rx))
+        if last == 0:
+            return results
+        ret = list(results)
+        quiet = []
+        for i in range(last + 1):
+            if len(results[i][0]):
+                self.resent += 1
+                ret[i] = self.txrx_batch([txs[i]])[0]
+            else:
+                quiet.append(i)
+        if quiet:
+            part = [txs[i] for i in quiet]
+            self.resent += len(part)
+            part_results = self.txrx_batch(part)
+            if any(len(rx) for rx, _times in part_results):
+                part_results = self.bisect_batch(part, part_results)
+            for i, result in zip(quiet, part_results):
+                ret[i] = result
+        return ret
+
+    def rx_times(self):
+        '''
+        (tx wall clock ns, first rx byte ns after tx, last rx byte ns after tx,
+        [(ns after tx, bytes) per rx chunk])
+        '''
+        if self.rx_first_ns is None:
+            return (self.tx_ns, 0, 0, [])
+        return (self.tx_ns, self.rx_first_ns - self.tx_done_ns,
+                self.rx_last_ns - self.tx_done_ns,
+                [(ns - self.tx_done_ns, n) for ns, n in self.rx_chunks])
+
+    def ser_configs(self):
+        if self.configs is not None:
+            return self.configs
+        return ser_configs(self.baudrates, self.parities, self.stopbitss,
+                           self.rtsctss, self.dsrdtrs, self.xonxoffs)
+
+    def ser_init(self, announce=True):
+        # Lazy: subclasses tweak the setting lists after __init__
+        if self.scheduler is None:
+            rng = StreamRandom(self.seed, self.worker, 0)
+            if self.schedule == "random":
+                self.scheduler = RandomScheduler(self.ser_configs(), rng=rng)
+            else:
+                self.scheduler = SweepScheduler(self.ser_configs(),
+                                                sweeps=self.sweeps,
+                                                rng=rng)
+        self.ser_settings = self.scheduler.next()
+        if announce:
+            self.print_settings()
+        self.mkser(**self.ser_settings._asdict())
+
+    def print_settings(self, settings=None):
+        if settings is None:
+            settings = self.ser_settings
         print("")
-        print("baudrate=%s, parity=%s, stopbits=%s" %
-              (baudrate, parity, stopbits))
-        self.mkser(baudrate=baudrate, parity=parity, stopbits=stopbits,
-             rtscts=random.choice(self.rtsctss),
-             dsrdtr=random.choice(self.dsrdtrs),
-             xonxoff=random.choice(self.xonxoffs))
+        print(settings)
 
     def loop_begin(self):
         pass
 
-    def run(self):
+    def mutation_alphabet(self):
+        if self.bytespec:
+            return self.bytespec.alphabet
+        if self.ascii:
+            return ASCII_ALPHABET + tobytes("".join(self.ascii_newlines))
+        return None
+
+    def mutation_keep(self):
+        '''
+        Bytes outside mutation_alphabet() that mutants may still contain:
+        prefixes / suffixes and tokens, unless forbidden outright
+        '''
+        if not self.bytespec:
+            return b""
+        keep = set(b"".join(self.bytespec.prefixes + self.bytespec.suffixes +
+                            list(self.tokens)))
+        return bytes(b for b in sorted(keep) if not self.bytespec.forbidden(b))
+
+    def next_case(self):
+        '''Generate stage: returns (iteration, tx)'''
+        self.itr += 1
+        self.rng = StreamRandom(self.seed, self.worker, self.itr)
+        self.rand.seed(self.rng)
+        self.chunk_size = self.rng.randint(1, 32)
+        self.loop_begin()
+        if self.mutate and self.corpus is None:
+            # Lazy: subclasses tweak tokens / alphabets after __init__
+            self.corpus = Corpus(self.rand,
+                                 tokens=self.tokens,
+                                 alphabet=self.mutation_alphabet(),
+                                 strict=bool(self.bytespec),
+                                 keep=self.mutation_keep())
+            for token in self.tokens:
+                self.corpus.add(token)
+        # Always drawn so generated cases don't depend on the corpus state
+        self.mutant = self.mutate and self.rng.random() < self.mutate_prob
+        if self.mutant and self.corpus.entries:
+            tx, self.parents[self.itr] = self.corpus.mutate()
+        else:
+            tx = self.get_tx(self.chunk_size)
+            if self.mutant:
+                # Corpus was empty, but regen() can't tell: capture it
+                self.parents[self.itr] = None
+        self.verbose and print("iter %04u, data(%u) = %s" %
+                               (self.itr, len(tx), tx.hex()))
+        return self.itr, tx
+
+    def regen(self, itr):
+        '''
+        tx of iteration itr without running up to it
+        Needs the same seed, worker and generation options as the run
+        None if it was a mutant: those depend on the corpus at the time
+        '''
+        self.itr = itr - 1
+        self.corpus = Corpus(self.rand)
+        _itr, tx = self.next_case()
+        self.corpus = None
+        if self.mutant:
+            return None
+        return tx
+
+    def txrx_case(self, itr, tx):
+        '''Wire stage: returns (rx, serial settings used, reopened, rx_times())'''
+        reopened = (itr - 1) % self.open_interval == 0
+        if reopened:
+            self.ser_init(announce=False)
+        self.verbose and print("writing")
+        rx = self.txrx(tx)
+        self.scheduler.update(self.ser_settings, rx_score(rx))
+        return rx, self.ser_settings, reopened, self.rx_times()
+
+    def log_case(self, itr, tx, rx, settings, reopened, times=(0, 0, 0, [])):
+        '''Log stage'''
+        if self.capture and (len(rx) or self.capture_silent
+                             or itr in self.parents):
+            self.capture.exchange(itr, settings, tx, rx, *times)
+        if reopened:
+            self.print_settings(settings)
+        if (itr - 1) % self.print_interval == 0:
+            print("")
+            print("iter %03u tx bytes: %u, rx bytes %u" %
+                  (itr - 1, self.tx_bytes, self.rx_bytes))
+            if self.batches:
+                print("batches: %u, %u answered, %u cases resent" %
+                      (self.batches, self.batches_answered, self.resent))
+            if itr > 1 and self.scheduler:
+                for mean, pulls, config in self.scheduler.best(3):
+                    print("  score %0.3f over %u: %s" % (mean, pulls, config))
+            if self.corpus:
+                best = max(self.corpus.entries,
+                           key=lambda entry: entry.finds,
+                           default=None)
+                print("corpus: %u entries" % len(self.corpus.entries))
+                if best and best.finds:
+                    print("  best: %u finds from %s" %
+                          (best.finds, best.tx.hex()))
+            if self.repeats:
+                print("repeated responses: %u" % self.repeats)
+                for count, normi, config, norm_rx in self.novelty_index.top(3):
+                    if count > 1:
+                        print("  #%u x %u: %s, rx %s" %
+                              (normi, count, config, norm_rx.hex() or "echo only"))
+            if self.repro_script:
+                self.repro_script.flush()
+        sys.stdout.write(".")
+        sys.stdout.flush()
+        self.tx_bytes += len(tx)
+        if len(rx):
+            self.rx_bytes += len(rx)
+            level, normi = self.novelty_index.check(tx, rx, settings)
+            if self.corpus is not None and level in ("norm", "shape"):
+                self.corpus.reward(self.parents.get(itr), tx, level)
+            if NOVELTY_LEVELS.index(level or "off") >= NOVELTY_LEVELS.index(self.novelty):
+                novelty = None
+                if level:
+                    novelty = "novel %s #%u" % (level, normi)
+                self.print_result(tx, rx, settings, novelty)
+            else:
+                self.repeats += 1
+        self.parents.pop(itr, None)
+        for hook in self.result_hooks:
+            hook(itr, tx, rx, settings)
+
+    def print_result(self, tx, rx, settings, novelty=None):
+        '''Settings, hexdumps and reproducers in a single write'''
+        out = ["\n%s\n" % (settings, )]
+        if novelty:
+            out.append(novelty + "\n")
+        out.append("tx %u\n" % len(tx))
+        out.append(hexdump_rows(tx))
+        out.append("rx %u\n" % len(rx))
+        out.append(hexdump_rows(rx))
+        for fmt in self.repro:
+            out.append(REPRO_FORMATS[fmt](tx, rx) + "\n")
+        sys.stdout.write("".join(out))
+        if self.repro_script:
+            self.repro_script.case(tx, rx, settings)
+
+    def set_parmrk(self, enable):
+        '''Have the tty driver mark framing / parity errors in the rx stream'''
+        if hasattr(self.ser, "parmrk"):
+            # Simulated transport, it marks errors itself
+            self.ser.parmrk = enable
+            return True
+        try:
+            fd = self.ser.fileno()
+        except (AttributeError, NotImplementedError):
+            return False
+        if termios is None:
+            return False
+        attrs = termios.tcgetattr(fd)
+        if enable:
+            attrs[0] |= termios.PARMRK | termios.INPCK
+            attrs[0] &= ~termios.IGNPAR
+        else:
+            attrs[0] &= ~(termios.PARMRK | termios.INPCK)
+        termios.tcsetattr(fd, termios.TCSANOW, attrs)
+        return True
+
+    def autobaud(self,
+                 baudrates=None,
+                 probes=None,
+                 rounds=4,
+                 threshold=0.6,
+                 margin=0.15):
+        '''
+        Guess line settings by probing every config and scoring what comes back
+        Each round sends the probe set to the surviving configs
+        Stops early once the best config leads the runner up by margin
+        Returns the best SerConfig or None if nothing ever answered
+        '''
+        if baudrates is None:
+            baudrates = AUTOBAUD_RATES
+        if probes is None:
+            probes = AUTOBAUD_PROBES
+        configs = ser_configs(baudrates, self.parities, self.stopbitss,
+                              self.rtsctss, self.dsrdtrs, self.xonxoffs)
+        print("Autobaud: %u configs, %u probes" % (len(configs), len(probes)))
+        # config => [score sum, scored probes]
+        scores = dict((config, [0.0, 0]) for config in configs)
+        alive = list(configs)
+
+        def mean(config):
+            total, n = scores[config]
+            return total / n if n else 0.0
+
+        for roundi in range(rounds):
+            for config in list(alive):
+                try:
+                    self.mkser(**config._asdict())
+                except (serial.SerialException, ValueError, OSError) as e:
+                    # Ex: adapter can't do the rate
+                    print("%s: skip, %s" % (config, e))
+                    alive.remove(config)
+                    del scores[config]
+                    continue
+                parmrk = self.set_parmrk(True)
+                for tx in probes:
+                    rx = self.txrx(tx)
+                    errors = 0
+                    if parmrk:
+                        rx, errors = unmark_parity(rx)
+                    score = autobaud_score(tx, rx, errors)
+                    if score is not None:
+                        scores[config][0] += score
+                        scores[config][1] += 1
+                if parmrk:
+                    self.set_parmrk(False)
+            ranked = sorted(alive, key=mean, reverse=True)
+            print("Round %u" % (roundi + 1, ))
+            for config in ranked[0:5]:
+                if scores[config][1]:
+                    print("  %0.3f over %u: %s" %
+                          (mean(config), scores[config][1], config))
+            if not ranked or not scores[ranked[0]][1]:
+                continue
+            best = mean(ranked[0])
+            runner_up = mean(ranked[1]) if len(ranked) > 1 else 0.0
+            if best >= threshold and best - runner_up >= margin:
+                break
+            # Clearly worse configs don't get more probes
+            alive = [config for config in ranked if mean(config) >= best - 0.3]
+
+        scored = [config for config in scores if scores[config][1]]
+        if not scored:
+            print("Autobaud: no config got a response")
+            return None
+        best = max(scored, key=mean)
+        print("Autobaud: %s (score %0.3f)" % (best, mean(best)))
+        return best
+
+    def run_begin(self):
         print("Starting")
         print("ASCII: %s" % self.ascii)
         print("Baudrates: %u" % len(self.baudrates))
         print("Parities: %u" % len(self.parities))
         print("Stopbits: %u" % len(self.stopbitss))
+        print("Configs: %u" % len(self.ser_configs()))
+        print("Seed: %u, worker %u" % (self.seed, self.worker))
+        if self.grammar:
+            print("Grammar: %u rules, %u enumerated commands, %s" %
+                  (len(self.grammar.rules), self.grammar.count(),
+                   self.grammar_mode))
+        if self.batch > 1:
+            print("Batch: %u cases, guard %s" %
+                  (self.batch, "%0.4f s" % self.guard if self.guard else
+                   "%u chars" % BATCH_GUARD_CHARS))
 
         self.itr = 0
-        open_interval = 10
-        print_interval = 80
-        tx_bytes = 0
-        rx_bytes = 0
-        baudrate = None
-        parity = None
-        stopbits = None
+        self.tx_bytes = 0
+        self.rx_bytes = 0
+
+    def run(self, count=None):
+        '''Fuzz forever, or for count cases'''
+        if self.batch > 1:
+            return self.run_batched(count)
+        self.run_begin()
+        while count is None or self.itr < count:
+            itr, tx = self.next_case()
+            self.log_case(itr, tx, *self.txrx_case(itr, tx))
+
+    def run_batched(self, count=None):
+        '''
+        Same as run(), but self.batch cases go out per response window
+        Quiet targets spend most of the time waiting out silence otherwise
+        '''
+        self.run_begin()
+        while count is None or self.itr < count:
+            n = self.batch
+            if count is not None:
+                n = min(n, count - self.itr)
+            cases = [self.next_case() for _i in range(n)]
+            reopened = any((itr - 1) % self.open_interval == 0
+                           for itr, _tx in cases)
+            if reopened:
+                self.ser_init(announce=False)
+            txs = [tx for _itr, tx in cases]
+            self.batches += 1
+            results = self.txrx_batch(txs)
+            if any(len(rx) for rx, _times in results):
+                self.batches_answered += 1
+                if self.bisect:
+                    results = self.bisect_batch(txs, results)
+            for i, ((itr, tx), (rx, times)) in enumerate(zip(cases, results)):
+                self.scheduler.update(self.ser_settings, rx_score(rx))
+                self.log_case(itr, tx, rx, self.ser_settings,
+                              reopened and i == 0, times)
+
+
+def port_worker(port, configs, log_dir, results, fuzz_class, fuzz_kwargs,
+                stampout, capture, worker=0, script=False,
+                stamp_mode='utc', stamp_resolution=0.001):
+    '''Fuzz one port, forwarding responses and stats to the orchestrator'''
+    port_dir = os.path.join(log_dir, os.path.basename(port))
+    mkdir_p(port_dir)
+    # Console belongs to the orchestrator, keep per port output in its own log
+    # multiprocessing skips atexit in children: flush explicitly on the way out
+    sink = BufferedSink()
+    flush_on_term()
+    sys.stdout = BufferedWriter(sink,
+                                [open(os.path.join(port_dir, 'log.txt'), 'a')])
+    sys.stderr = sys.stdout
+    fuzz_kwargs = dict(fuzz_kwargs, worker=worker)
+    if capture:
+        fuzz_kwargs["capture"] = CaptureWriter(
+            os.path.join(port_dir, "capture.sfz"),
+            session=dict(port=port, seed=fuzz_kwargs.get("seed"),
+                         worker=worker))
+    if script:
+        fuzz_kwargs["repro_script"] = ReproScript(
+            os.path.join(port_dir, "repro.py"), port)
+    try:
+        port_worker_run(port, configs, results, fuzz_class, fuzz_kwargs,
+                        stampout, stamp_mode, stamp_resolution)
+    finally:
+        # Only stopped by the orchestrator: don't hang flushing a backlog of
+        # results nobody will read
+        results.cancel_join_thread()
+        sink.flush()
+        if capture:
+            fuzz_kwargs["capture"].close()
+        if script:
+            fuzz_kwargs["repro_script"].close()
+
+
+def port_worker_run(port, configs, results, fuzz_class, fuzz_kwargs,
+                    stampout, stamp_mode='utc', stamp_resolution=0.001):
+    if stampout:
+        _outdate = IOTimestamp(sys, 'stdout', stamp_mode, stamp_resolution)
+        _errdate = IOTimestamp(sys, 'stderr', stamp_mode, stamp_resolution)
+
+    sf = fuzz_class(port=port, configs=configs, **fuzz_kwargs)
+
+    def hook(itr, tx, rx, settings):
+        if len(rx):
+            results.put(("rx", port, settings, bytes(tx), bytes(rx)))
+        if itr % sf.print_interval == 0:
+            results.put(("stats", port, itr, sf.tx_bytes, sf.rx_bytes))
+
+    sf.result_hooks.append(hook)
+    sf.run()
+
+
+def fuzz_ports(ports,
+               log_dir,
+               configs,
+               fuzz_class=SFuzz,
+               fuzz_kwargs=None,
+               stampout=False,
+               capture=False,
+               stat_interval=10.0,
+               script=False,
+               stamp_mode='utc',
+               stamp_resolution=0.001,
+               summary_max=20):
+    '''
+    Fuzz several identical targets at once, one process per port
+    configs is dealt out round robin so each port covers its own slice
+    Responses are merged into findings.txt, one entry per unique (settings, rx)
+    The summary at exit lists the summary_max most frequent
+    Port i is worker i of fuzz_kwargs["seed"] (picked here if not given)
+    '''
+    fuzz_kwargs = dict(fuzz_kwargs or {})
+    if fuzz_kwargs.get("seed") is None:
+        fuzz_kwargs["seed"] = new_seed()
+    print("Seed: %u" % fuzz_kwargs["seed"])
+    results = multiprocessing.Queue()
+    procs = []
+    for porti, port in enumerate(ports):
+        port_configs = configs[porti::len(ports)]
+        if not port_configs:
+            # More ports than configs: double up
+            port_configs = [configs[porti % len(configs)]]
+        print("%s: %u configs" % (port, len(port_configs)))
+        proc = multiprocessing.Process(target=port_worker,
+                                       args=(port, port_configs, log_dir,
+                                             results, fuzz_class, fuzz_kwargs,
+                                             stampout, capture, porti,
+                                             script, stamp_mode,
+                                             stamp_resolution),
+                                       daemon=True)
+        proc.start()
+        procs.append(proc)
+
+    tstart = time.time()
+    tstat = tstart
+    # (settings, rx) => [count, port, tx]
+    findings = {}
+    # port => (itr, tx bytes, rx bytes)
+    stats = {}
+    findings_f = open(os.path.join(log_dir, 'findings.txt'), 'a')
+    try:
         while True:
-            if self.itr % open_interval == 0:
-                self.ser_init()
-
-            if self.itr % print_interval == 0:
-                print("")
-                print("iter %03u tx bytes: %u, rx bytes %u" %
-                      (self.itr, tx_bytes, rx_bytes))
-            sys.stdout.write(".")
-            sys.stdout.flush()
-            self.itr += 1
-            self.chunk_size = random.randint(1, 32)
-            self.loop_begin()
-            tx = self.get_tx(self.chunk_size)
-            self.verbose and print("iter %04u, data(%u) = %s" %
-                                   (self.itr, len(tx), tx.hex()))
-            self.verbose and print("writing")
-            rx = self.txrx(tx)
-            tx_bytes += len(tx)
-            if not len(rx):
-                continue
-            rx_bytes += len(rx)
-            print("")
-            print("baudrate=%s, parity=%s, stopbits=%s" %
-                  (baudrate, parity, stopbits))
-            hexdump(tx, label="tx %u" % len(tx))
-            hexdump(rx, label="rx %u" % len(rx))
-            print("# rx = %s" % bytes2AnonArray(rx))
-            print("sf.txrx(%s)" % bytes2AnonArray(tx))
+            try:
+                msg = results.get(timeout=1.0)
+            except queue.Empty:
+                msg = None
+            if msg and msg[0] == "rx":
+                _msgtype, port, settings, tx, rx = msg
+                key = (settings, rx)
+                finding = findings.get(key)
+                if finding:
+                    finding[0] += 1
+                else:
+                    findings[key] = [1, port, tx]
+                    with contextlib.redirect_stdout(findings_f):
+                        print("")
+                        print("port=%s, %s" % (port, settings))
+                        hexdump(tx, label="tx %u" % len(tx))
+                        hexdump(rx, label="rx %u" % len(rx))
+                        for fmt in fuzz_kwargs.get("repro") or ["txrx"]:
+                            print(REPRO_FORMATS[fmt](tx, rx))
+                    findings_f.flush()
+            elif msg and msg[0] == "stats":
+                _msgtype, port, itr, tx_bytes, rx_bytes = msg
+                stats[port] = (itr, tx_bytes, rx_bytes)
+
+            if time.time() - tstat >= stat_interval:
+                tstat = time.time()
+                itrs = sum(stat[0] for stat in stats.values())
+                print("ports %u/%u alive, iter %u (%0.1f / s), tx bytes: %u, rx bytes %u, findings %u" %
+                      (sum(proc.is_alive() for proc in procs), len(procs), itrs,
+                       itrs / (tstat - tstart),
+                       sum(stat[1] for stat in stats.values()),
+                       sum(stat[2] for stat in stats.values()), len(findings)))
+                if not any(proc.is_alive() for proc in procs):
+                    break
+    finally:
+        for proc in procs:
+            proc.terminate()
+        # A worker doesn't exit until its queue feeder has flushed into the
+        # pipe: keep draining, kill whatever is still stuck after a while
+        tstop = time.time()
+        while any(proc.is_alive() for proc in procs) and time.time() - tstop < 5.0:
+            try:
+                results.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        for proc in procs:
+            if proc.is_alive():
+                proc.kill()
+            proc.join()
+        findings_f.close()
+        print("")
+        print("Findings: %u unique" % len(findings))
+        top = sorted(findings.items(), key=lambda kv: -kv[1][0])
+        for (settings, rx), (count, port, tx) in top[0:summary_max]:
+            print("  %6u x %s: rx %s" % (count, settings, rx.hex()))
+        if len(top) > summary_max:
+            print("  ... %u more in %s" %
+                  (len(top) - summary_max, os.path.join(log_dir, 'findings.txt')))
 
 
 def main():
     parser = argparse.ArgumentParser(description="Try to figure out an undocumented serial protocol")
-    parser.add_argument("--port", default=None, help="Serial port")
+    parser.add_argument("--port", default=None, help="Serial port, comma separated list or \"all\" to fuzz several")
     parser.add_argument("--dir", default=None, help="Output dir")
     parser.add_argument("--postfix", default=None, help="")
     parser.add_argument("--baudrate", default=None, type=int, help="Set baudrate")
     parser.add_argument("--aggressive", action="store_true", help="Use less common serial modes")
     add_bool_arg(parser, "--ascii", help="Only send ASCII chars")
     add_bool_arg(parser, "--timedate", default=False, help="Display prefix")
+    parser.add_argument("--timedate-mode", default="utc", choices=["utc", "mono", "ns"], help="utc: wall clock, mono: monotonic clock as date, ns: raw monotonic ns")
+    parser.add_argument("--timedate-res", default=0.001, type=float, help="Timestamp resolution in seconds")
+    add_bool_arg(parser, "--capture", default=True, help="Record every exchange to capture.sfz in the output dir")
+    add_bool_arg(parser, "--buffered", default=True, help="Batch log writes from a background thread")
+    parser.add_argument("--allow", default=None, help="Only send these bytes, hex ranges (ex: 20-7E,0D,0A)")
+    parser.add_argument("--forbid", default=None, help="Never send these bytes, hex ranges (ex: 03,1B)")
+    parser.add_argument("--mask7", action="store_true", help="Only send 7 bit bytes")
+    parser.add_argument("--weight", action="append", default=[], help="Relative byte weight, hex byte=weight (ex: 0D=8)")
+    parser.add_argument("--prefix", action="append", default=[], help="Payload prefix to choose from (ex: *)")
+    parser.add_argument("--prefix-prob", default=1.0, type=float, help="Odds of adding a --prefix")
+    parser.add_argument("--suffix", action="append", default=[], help="Payload suffix to choose from (ex: \\r)")
+    parser.add_argument("--suffix-prob", default=1.0, type=float, help="Odds of adding a --suffix")
+    parser.add_argument("--rx-timeout", default=None, type=float, help="Seconds to wait for the first response byte (default: adapter latency + 10 character times)")
+    parser.add_argument("--adapter-latency", default=None, type=float, help="Seconds the adapter may hold rx before delivering it, floor of the rx gap (default: %s, %s with --low-latency)" % (ADAPTER_LATENCY, LOW_LATENCY))
+    parser.add_argument("--rx-gap", default=4, type=float, help="Response is over after this many idle character times")
+    parser.add_argument("--rx-term", default=None, help="Response is over after this terminator (ex: \\r\\n)")
+    parser.add_argument("--rx-len", default=None, type=int, help="Response is over after this many bytes")
+    add_bool_arg(parser, "--persistent", default=True, help="Keep the port open and reconfigure in place (--no-persistent reopens it)")
+    parser.add_argument("--reset", action="store_true", help="Pulse DTR/RTS to reset the target after each reconfiguration")
+    parser.add_argument("--schedule", default="sweep", choices=["sweep", "random"], help="sweep covers every serial config, then favors responsive ones")
+    parser.add_argument("--sweeps", default=1, type=int, help="Times to visit every serial config before favoring responsive ones")
+    parser.add_argument("--autobaud", action="store_true", help="Guess line settings from probe responses instead of fuzzing")
+    parser.add_argument("--novelty", default="norm", choices=NOVELTY_LEVELS, help="Only fully log responses this novel (off: log all)")
+    parser.add_argument("--mutate", action="store_true", help="Coverage guided: mutate inputs that got new responses")
+    parser.add_argument("--token", action="append", default=[], help="Dictionary token for --mutate (ex: *VN\\r)")
+    parser.add_argument("--dict", default=None, help="File of --token's, one per line")
+    parser.add_argument("--seed", default=None, type=int, help="Run seed, random if not given")
+    parser.add_argument("--worker", default=0, type=int, help="With --regen: worker (port index) of a multi port run")
+    parser.add_argument("--regen", default=None, type=int, help="Print the tx of this iteration of --seed and exit (give the run's generation options too)")
+    parser.add_argument("--low-latency", action="store_true", help="Set ASYNC_LOW_LATENCY (and FTDI latency_timer 1 ms) for accurate rx timing")
+    parser.add_argument("--batch", default=1, type=int, help="Send this many cases per response window")
+    parser.add_argument("--sim", default=None, choices=list(SIM_DEVICES), help="Fuzz a simulated target instead of a serial port")
+    parser.add_argument("--sim-baudrate", default=9600, type=int, help="Baud rate the --sim target really uses")
+    parser.add_argument("--sim-parity", default="N", help="Parity the --sim target really uses")
+    parser.add_argument("--sim-latency", default=0.0005, type=float, help="Seconds the --sim target takes to start answering")
+    parser.add_argument("--guard", default=None, type=float, help="Seconds to listen between batched cases (default: %u character times)" % BATCH_GUARD_CHARS)
+    add_bool_arg(parser, "--bisect", default=True, help="Resend cases of batches that got a response until it is pinned on one case (--no-bisect: go by arrival time)")
+    add_bool_arg(parser, "--capture-silent", default=True, help="Also capture generated cases that got no response (--regen can recreate them)")
+    parser.add_argument("--grammar", default=None, help="Generate commands from this grammar file (see grammar.py)")
+    parser.add_argument("--grammar-mode", default="sample", choices=["sample", "enumerate"], help="enumerate walks every combination in order, then repeats")
+    parser.add_argument("--repro", action="append", default=None, choices=list(REPRO_FORMATS), help="Reproducer printed for each logged case, repeat for several (default: txrx)")
+    add_bool_arg(parser, "--script", default=False, help="Also write logged cases to a runnable repro.py in the output dir")
     parser.add_argument("--verbose", action="store_true")
     args = parser.parse_args()
 
+    latency = args.adapter_latency
+    if latency is None:
+        latency = LOW_LATENCY if args.low_latency else ADAPTER_LATENCY
+    completion = RxCompletion(timeout=args.rx_timeout,
+                              gap_chars=args.rx_gap,
+                              length=args.rx_len,
+                              latency=latency)
+    if args.rx_term:
+        completion.terminator = parse_escapes(args.rx_term)
+
+    bytespec = None
+    if args.allow or args.forbid or args.mask7 or args.weight or args.prefix or args.suffix:
+        weights = {}
+        for weight in args.weight:
+            b, w = weight.split("=")
+            weights[int(b, 16)] = float(w)
+        bytespec = ByteSpec(
+            allow=parse_byteset(args.allow) if args.allow else None,
+            forbid=parse_byteset(args.forbid) if args.forbid else b"",
+            mask7=args.mask7,
+            weights=weights,
+            prefixes=[parse_escapes(prefix) for prefix in args.prefix],
+            prefix_prob=args.prefix_prob,
+            suffixes=[parse_escapes(suffix) for suffix in args.suffix],
+            suffix_prob=args.suffix_prob)
+
+    tokens = [parse_escapes(token) for token in args.token]
+    if args.dict:
+        with open(args.dict) as f:
+            for line in f:
+                line = line.rstrip("\n")
+                if line and not line.startswith("#"):
+                    tokens.append(parse_escapes(line))
+
+    grammar = None
+    if args.grammar:
+        grammar = Grammar.load(args.grammar)
+
     baudrates = None
     parities = None
     stopbitss = None
@@ -465,28 +2273,137 @@ def main():
         baudrates = [int(args.baudrate)]
 
     if args.aggressive:
-        parities = [
-                    serial.PARITY_NONE, serial.PARITY_EVEN, serial.PARITY_ODD,
-                    serial.PARITY_MARK, serial.PARITY_SPACE
-                ]
-        stopbitss = [
-                    serial.STOPBITS_ONE, serial.STOPBITS_ONE_POINT_FIVE,
-                    serial.STOPBITS_TWO
-                ]
+        parities = list(PARITIES)
+        stopbitss = list(STOPBITSS)
+
+    transport = None
+    if args.sim:
+        transport = SIM_DEVICES[args.sim](baudrate=args.sim_baudrate,
+                                          parity=args.sim_parity.upper(),
+                                          latency=args.sim_latency).open
+        args.port = args.port or "sim"
+
+    ports = None
+    if args.port == "all":
+        ports = serial_ports()
+        if not ports:
+            raise Exception("Could not detect any serial ports")
+    elif args.port and "," in args.port:
+        ports = args.port.split(",")
+
+    seed = args.seed
+    if seed is None:
+        seed = new_seed()
+
+    if args.regen is not None:
+        if args.seed is None:
+            raise Exception("--regen needs the run's --seed")
+        # Generation only, never opens the port
+        sf = SFuzz(port=args.port or os.devnull,
+                   ascii=args.ascii,
+                   bytespec=bytespec,
+                   mutate=args.mutate,
+                   tokens=tokens,
+                   seed=seed,
+                   worker=args.worker,
+                   grammar=grammar,
+                   grammar_mode=args.grammar_mode)
+        tx = sf.regen(args.regen)
+        if tx is None:
+            print("itr %u was a mutant, look it up in the capture" % args.regen)
+            sys.exit(1)
+        hexdump(tx, label="tx %u" % len(tx))
+        print("sf.txrx(%s)" % bytes2AnonArray(tx))
+        return
 
     log_dir = args.dir
     if log_dir is None:
         log_dir = default_date_dir("log", "", args.postfix)
     mkdir_p(log_dir)
-    _dt = logwt(log_dir, 'log.txt', shift_d=False, stampout=args.timedate)
+    _dt = logwt(log_dir,
+                'log.txt',
+                shift_d=False,
+                stampout=args.timedate,
+                buffered=args.buffered,
+                stamp_mode=args.timedate_mode,
+                stamp_resolution=args.timedate_res)
+
+    if ports:
+        configs = ser_configs(baudrates or BAUDRATES, parities or PARITIES,
+                              stopbitss or STOPBITSS)
+        fuzz_ports(ports,
+                   log_dir,
+                   configs,
+                   fuzz_kwargs=dict(ascii=args.ascii,
+                                    verbose=args.verbose,
+                                    completion=completion,
+                                    persistent=args.persistent,
+                                    reset=args.reset,
+                                    schedule=args.schedule,
+                                    sweeps=args.sweeps,
+                                    bytespec=bytespec,
+                                    novelty=args.novelty,
+                                    mutate=args.mutate,
+                                    tokens=tokens,
+                                    seed=seed,
+                                    capture_silent=args.capture_silent,
+                                    batch=args.batch,
+                                    guard=args.guard,
+                                    bisect=args.bisect,
+                                    low_latency=args.low_latency,
+                                    transport=transport,
+                                    repro=args.repro,
+                                    grammar=grammar,
+                                    grammar_mode=args.grammar_mode),
+                   stampout=args.timedate,
+                   capture=args.capture,
+                   script=args.script,
+                   stamp_mode=args.timedate_mode,
+                   stamp_resolution=args.timedate_res)
+        return
+
+    capture = None
+    if args.capture:
+        capture = CaptureWriter(os.path.join(log_dir, "capture.sfz"),
+                                session=dict(port=args.port, argv=sys.argv,
+                                             seed=seed, worker=0))
 
     sf = SFuzz(port=args.port,
         ascii=args.ascii,
         baudrates=baudrates,
         parities=parities,
         stopbitss=stopbitss,
-        verbose=args.verbose)
-    sf.run()
+        verbose=args.verbose,
+        completion=completion,
+        persistent=args.persistent,
+        reset=args.reset,
+        schedule=args.schedule,
+        sweeps=args.sweeps,
+        bytespec=bytespec,
+        novelty=args.novelty,
+        mutate=args.mutate,
+        tokens=tokens,
+        capture=capture,
+        seed=seed,
+        capture_silent=args.capture_silent,
+        batch=args.batch,
+        guard=args.guard,
+        bisect=args.bisect,
+        low_latency=args.low_latency,
+        transport=transport,
+        repro=args.repro,
+        grammar=grammar,
+        grammar_mode=args.grammar_mode,
+        repro_script=ReproScript(os.path.join(log_dir, "repro.py"), args.port)
+        if args.script else None)
+    if args.autobaud:
+        if parities is None:
+            sf.parities = [serial.PARITY_NONE, serial.PARITY_EVEN, serial.PARITY_ODD]
+        if stopbitss is None:
+            sf.stopbitss = [serial.STOPBITS_ONE]
+        sf.autobaud(baudrates=baudrates)
+    else:
+        sf.run()
 
 
 if __name__ == "__main__":
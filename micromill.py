@@ -7,16 +7,61 @@ helps validate 9600 baud theory
 
 import argparse
 import serial
-import random
-import string
-
-from main import default_date_dir, mkdir_p, logwt, SFuzz, tobytes
+import sys
+
+from main import default_date_dir, mkdir_p, logwt, SFuzz, tobytes, ASCII_ALPHABET, ByteSpec, hexdump, bytes2AnonArray
+from sim import SimDevice
+from grammar import Grammar
+
+# ^C, ^[ and these letters have side effects, don't send them at random
+# 7 bit so 0x83 / 0x9B (^C / ^[ with the high bit set) can't happen either
+BINARY_SPEC = ByteSpec(mask7=True, forbid=b"\x03\x1B*XYZ")
+
+
+class MillSim(SimDevice):
+    '''
+    Stand-in for the mill, pieced together from the notes below. A guess!
+    -9600 8N1
+    -echoes with the high bit stripped (89 BF 42 .. => 09 3F 42 ..)
+    -*VN\r gets a version string
+    -^C clicks, ESC X / Y / Z do something, neither answers
+    '''
+    def __init__(self, **kwargs):
+        kwargs.setdefault("baudrate", 9600)
+        SimDevice.__init__(self, **kwargs)
+        self.buf = b""
+
+    def handle(self, data):
+        ret = b""
+        for b in data:
+            if b == 0x03:
+                self.buf = b""
+                continue
+            if self.buf.endswith(b"\x1B") and b in b"XYZ":
+                self.buf = b""
+                continue
+            self.buf += bytes([b])
+            if b == 0x0D:
+                if self.buf.endswith(b"*VN\r"):
+                    ret += b"MM V1.0\r"
+                self.buf = b""
+            ret += bytes([b & 0x7F])
+        return ret
+
+    def reset(self):
+        self.buf = b""
 
 
 class MyFuzz(SFuzz):
     def __init__(self, *args, **kwargs):
         SFuzz.__init__(self, *args, **kwargs)
         self.rtsctss = [True]
+        # Things that got a reaction so far, see test modes below
+        # Added to what SFuzz collected (ex: --grammar literals)
+        self.tokens = list(self.tokens) + [b"VN", b"*VN\r", b"*ON\r", b"*OF\r", b"\x1BX", b"\x1BY", b"\x1BZ"]
+        if not self.ascii:
+            # Keep mutants clear of the side effect bytes too
+            self.bytespec = BINARY_SPEC
     
     def loop_begin(self):
         # reset state before every test
@@ -24,57 +69,48 @@ class MyFuzz(SFuzz):
         #    self.txrx(b"\x03")
         # self.chunk_size = 3
 
-        self.chunk_size = random.randint(1, 6)
+        self.chunk_size = self.rng.randint(1, 6)
 
 
     def get_tx(self, chunk_size):
+        if self.grammar:
+            return SFuzz.get_tx(self, chunk_size)
+
         def rand_ascii(n):
-            return ''.join(
-                random.choice(string.ascii_uppercase + string.digits)
-                for _ in range(n))
+            return bytes(self.rand.randbytes(n, ASCII_ALPHABET)).decode('ascii')
 
         if self.ascii:
             prefix = ""
             postfix = ""
             # if self.ascii_newlines:
-            #    postfix = random.choice(self.ascii_newlines)
-            if random.randint(0, 8) == 0:
-                prefix = random.choice(["\x03", "\x1B", "\n", "X", "*", ";"])
-            if random.randint(0, 8) == 0:
-                postfix = random.choice(["\x03", "\x1B", "\n", "X", "*", ";"])
-            if 1 or random.randint(0, 2) == 0:
+            #    postfix = self.rng.choice(self.ascii_newlines)
+            if self.rng.randint(0, 8) == 0:
+                prefix = self.rng.choice(["\x03", "\x1B", "\n", "X", "*", ";"])
+            if self.rng.randint(0, 8) == 0:
+                postfix = self.rng.choice(["\x03", "\x1B", "\n", "X", "*", ";"])
+            if 1 or self.rng.randint(0, 2) == 0:
                 ret = "VN"
-                if random.randint(0, 1):
+                if self.rng.randint(0, 1):
                     ret = rand_ascii(1) + ret
-                if random.randint(0, 1):
+                if self.rng.randint(0, 1):
                     ret = ret + rand_ascii(1)
             else:
                 ret = rand_ascii(chunk_size - len(prefix) - len(postfix))
             return tobytes(prefix + ret + postfix)
         else:
-            # FIXME: hack
-            while True:
-                ret = bytearray(
-                    [random.randint(0, 127) for _i in range(chunk_size)])
-                # ^C
-                if 0x03 in ret or 0x83 in ret:
-                    # print("regen")
-                    continue
-                # ^[
-                if 0x1B in ret or 0x9B in ret:
-                    continue
-                if ord("*") in ret or ord("X") in ret or ord("Y") in ret or ord("Z") in ret:
-                    continue
-                return ret
-
-            return bytearray(
-                [random.randint(0, 255) for _i in range(chunk_size)])
+            return BINARY_SPEC.generate(self.rand, chunk_size)
 
 def main():
     parser = argparse.ArgumentParser(description="Try to figure out an undocumented serial protocol")
     parser.add_argument("--port", default=None, help="Serial port")
     parser.add_argument("--dir", default=None, help="Output dir")
     parser.add_argument("--postfix", default="micromill", help="")
+    parser.add_argument("--mutate", action="store_true", help="Coverage guided fuzzing")
+    parser.add_argument("--seed", default=None, type=int, help="Run seed, random if not given")
+    parser.add_argument("--grammar", default=None, help="Generate commands from a grammar file (ex: micromill.grammar)")
+    parser.add_argument("--grammar-mode", default="sample", choices=["sample", "enumerate"], help="enumerate walks every combination in order")
+    parser.add_argument("--regen", default=None, type=int, help="Print the tx of this iteration of --seed and exit (give the run's --mutate / --grammar too)")
+    parser.add_argument("--sim", action="store_true", help="Fuzz a simulated mill (MillSim) instead of the real one")
     parser.add_argument("--verbose", action="store_true")
     parser.add_argument("mode", nargs="?", default="fuzz")
     args = parser.parse_args()
@@ -96,18 +132,48 @@ def main():
     # parities = [serial.PARITY_NONE]
     # stopbitss = [serial.STOPBITS_ONE]
 
+    grammar = Grammar.load(args.grammar) if args.grammar else None
+
+    if args.regen is not None:
+        if args.seed is None:
+            raise Exception("--regen needs the run's --seed")
+        # MyFuzz generates differently from plain SFuzz, main.py --regen won't do
+        sf = MyFuzz(port=args.port or "regen",
+                    ascii=True,
+                    mutate=args.mutate,
+                    seed=args.seed,
+                    grammar=grammar,
+                    grammar_mode=args.grammar_mode)
+        tx = sf.regen(args.regen)
+        if tx is None:
+            print("itr %u was a mutant, look it up in the capture" % args.regen)
+            sys.exit(1)
+        hexdump(tx, label="tx %u" % len(tx))
+        print("sf.txrx(%s)" % bytes2AnonArray(tx))
+        return
+
     log_dir = args.dir
     if log_dir is None:
         log_dir = default_date_dir("log", "", args.postfix)
     mkdir_p(log_dir)
     _dt = logwt(log_dir, 'log.txt', shift_d=False, stampout=False)
 
+    transport = None
+    if args.sim:
+        transport = MillSim().open
+        args.port = args.port or "sim"
+
     sf = MyFuzz(port=args.port,
         ascii=True,
         baudrates=[9600],
         parities=[serial.PARITY_NONE],
         stopbitss=[serial.STOPBITS_ONE],
-        verbose=args.verbose)
+        verbose=args.verbose,
+        mutate=args.mutate,
+        seed=args.seed,
+        transport=transport,
+        grammar=grammar,
+        grammar_mode=args.grammar_mode)
     if args.mode == "fuzz":
         sf.run()
     else:
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+
+"""
+Shrink a tx to the fewest bytes that still get the interesting response (ddmin)
+ex: ./minimize.py --baudrate 9600 --tx '\\x7E\\x54\\x53\\x6F' --rx-prefix '\\x59'
+ex: ./minimize.py --session log/2024-01-01_01 --itr 1234 --port /dev/ttyUSB0,/dev/ttyUSB1
+Several ports must be identical targets, candidates are tried on them in parallel
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+
+from capture import CaptureReader
+from main import default_date_dir, mkdir_p, logwt, hexdump, bytes2AnonArray, SFuzz, SerConfig, RxCompletion, parse_escapes, add_bool_arg
+
+
+class RxPredicate(object):
+    '''What makes a response interesting, everything given must hold'''
+    def __init__(self, rx=None, prefix=None, nonempty=False, contains=None):
+        self.rx = rx
+        self.prefix = prefix
+        self.nonempty = nonempty
+        self.contains = contains
+
+    def __call__(self, rx):
+        if self.rx is not None and rx != self.rx:
+            return False
+        if self.prefix is not None and not rx.startswith(self.prefix):
+            return False
+        if self.nonempty and not rx:
+            return False
+        if self.contains is not None and self.contains not in rx:
+            return False
+        return True
+
+    def __str__(self):
+        ret = []
+        if self.rx is not None:
+            ret.append("rx=%s" % self.rx.hex())
+        if self.prefix is not None:
+            ret.append("prefix=%s" % self.prefix.hex())
+        if self.nonempty:
+            ret.append("nonempty")
+        if self.contains is not None:
+            ret.append("contains=%s" % self.contains.hex())
+        return ", ".join(ret) or "anything"
+
+
+def reproduces(sf, tx, predicate, tries):
+    '''Any of tries attempts will do: absorbs dropped or garbled responses'''
+    for _try in range(tries):
+        if predicate(sf.txrx(tx)):
+            return True
+    return False
+
+
+class Tester(object):
+    '''Caches results and tries candidates width at a time'''
+    def __init__(self, width=1):
+        self.width = width
+        # tx => interesting
+        self.cache = {}
+        self.tests = 0
+
+    def test_many(self, txs):
+        '''txs => [interesting] in the same order, subclasses provide it'''
+        raise NotImplementedError()
+
+    def first(self, candidates):
+        '''Index of the first interesting candidate, None if none are'''
+        for start in range(0, len(candidates), self.width):
+            window = candidates[start:start + self.width]
+            todo = list(dict.fromkeys(tx for tx in window if tx not in self.cache))
+            if todo:
+                self.tests += len(todo)
+                for tx, ok in zip(todo, self.test_many(todo)):
+                    self.cache[tx] = ok
+            for i, tx in enumerate(window):
+                if self.cache[tx]:
+                    return start + i
+        return None
+
+
+class LocalTester(Tester):
+    def __init__(self, sf, predicate, tries=3):
+        Tester.__init__(self)
+        self.sf = sf
+        self.predicate = predicate
+        self.tries = tries
+
+    def test_many(self, txs):
+        return [reproduces(self.sf, tx, self.predicate, self.tries) for tx in txs]
+
+
+def minimize_worker(port, config, sf_kwargs, predicate, tries, jobs, results):
+    sf = SFuzz(port=port, **sf_kwargs)
+    sf.mkser(**config._asdict())
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        i, tx = job
+        results.put((i, reproduces(sf, tx, predicate, tries)))
+
+
+class PortPool(Tester):
+    '''One worker process per port, a window is one candidate per port'''
+    def __init__(self, ports, config, sf_kwargs, predicate, tries=3):
+        Tester.__init__(self, width=len(ports))
+        self.jobs = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+        self.procs = []
+        for port in ports:
+            proc = multiprocessing.Process(target=minimize_worker,
+                                           args=(port, config, sf_kwargs,
+                                                 predicate, tries, self.jobs,
+                                                 self.results),
+                                           daemon=True)
+            proc.start()
+            self.procs.append(proc)
+
+    def test_many(self, txs):
+        for job in enumerate(txs):
+            self.jobs.put(job)
+        ret = [None] * len(txs)
+        for _i in range(len(txs)):
+            i, ok = self.results.get()
+            ret[i] = ok
+        return ret
+
+    def close(self):
+        for _proc in self.procs:
+            self.jobs.put(None)
+        for proc in self.procs:
+            proc.join(timeout=1.0)
+            proc.terminate()
+
+
+def ddmin(data, tester, verbose=False):
+    '''
+    Zeller's delta debugging
+    Try each of n chunks alone, then each with that chunk removed
+    On success continue from the smaller input, otherwise double n
+    '''
+    n = 2
+    while len(data) >= 2:
+        bounds = [len(data) * i // n for i in range(n + 1)]
+        subsets = [data[bounds[i]:bounds[i + 1]] for i in range(n)]
+        candidates = list(subsets)
+        if n > 2:
+            candidates += [data[:bounds[i]] + data[bounds[i + 1]:] for i in range(n)]
+        i = tester.first(candidates)
+        if i is not None:
+            data = candidates[i]
+            # Chunk alone: start over coarse. Complement: keep the granularity
+            n = 2 if i < n else max(n - 1, 2)
+            verbose and print("%u bytes: %s" % (len(data), data.hex()))
+            continue
+        if n >= len(data):
+            break
+        n = min(2 * n, len(data))
+    return data
+
+
+def session_case(path, itr):
+    '''(SerConfig, tx, rx) of exchange itr in a capture or log dir'''
+    if os.path.isdir(path):
+        path = os.path.join(path, "capture.sfz")
+    reader = CaptureReader(path)
+    ret = None
+    for ex in reader:
+        if ex.itr == itr:
+            ret = (SerConfig(*ex.config) if ex.config else None, bytes(ex.tx), bytes(ex.rx))
+            break
+    ex = None
+    reader.close()
+    if ret is None:
+        raise Exception("%s: no itr %u" % (path, itr))
+    return ret
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Shrink a tx that gets an interesting response")
+    parser.add_argument("--port", default=None, help="Serial port or comma separated list of identical targets")
+    parser.add_argument("--dir", default=None, help="Output dir")
+    parser.add_argument("--postfix", default="minimize", help="")
+    parser.add_argument("--session", default=None, help="Take tx, rx and settings from this capture.sfz or log dir")
+    parser.add_argument("--itr", default=None, type=int, help="Exchange in --session to minimize")
+    parser.add_argument("--tx", default=None, help="tx to minimize, backslash escapes ok")
+    parser.add_argument("--baudrate", default=None, type=int, help="Settings if not from --session")
+    parser.add_argument("--parity", default="N", help="Settings if not from --session")
+    parser.add_argument("--stopbits", default=1, type=float, help="Settings if not from --session")
+    parser.add_argument("--rx", default=None, help="Interesting: rx is exactly (default with --session: as recorded)")
+    parser.add_argument("--rx-prefix", default=None, help="Interesting: rx starts with")
+    parser.add_argument("--nonempty", action="store_true", help="Interesting: any rx")
+    parser.add_argument("--contains", default=None, help="Interesting: rx contains these byte(s)")
+    parser.add_argument("--tries", default=3, type=int, help="Attempts before a candidate is called uninteresting")
+    parser.add_argument("--rx-timeout", default=None, type=float, help="Seconds to wait for the first response byte (default: adapter latency + 10 character times)")
+    parser.add_argument("--rx-gap", default=4, type=float, help="Response is over after this many idle character times")
+    add_bool_arg(parser, "--persistent", default=True, help="Keep the port open and reconfigure in place")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    config = None
+    tx = None
+    rx = None
+    if args.session:
+        if args.itr is None:
+            raise Exception("--session needs --itr")
+        config, tx, rx = session_case(args.session, args.itr)
+    if args.tx is not None:
+        tx = parse_escapes(args.tx)
+    if tx is None:
+        raise Exception("Need --tx or --session")
+    if args.baudrate:
+        stopbits = int(args.stopbits) if args.stopbits == int(args.stopbits) else args.stopbits
+        config = SerConfig(args.baudrate, args.parity.upper(), stopbits,
+                           False, False, False)
+    if config is None:
+        raise Exception("Need --baudrate or --session")
+
+    predicate = RxPredicate(
+        rx=parse_escapes(args.rx) if args.rx is not None else None,
+        prefix=parse_escapes(args.rx_prefix) if args.rx_prefix is not None else None,
+        nonempty=args.nonempty,
+        contains=parse_escapes(args.contains) if args.contains is not None else None)
+    if str(predicate) == "anything":
+        if rx is None:
+            raise Exception("Need a response predicate (ex: --nonempty)")
+        predicate.rx = rx
+
+    log_dir = args.dir
+    if log_dir is None:
+        log_dir = default_date_dir("log", "", args.postfix)
+    mkdir_p(log_dir)
+    _dt = logwt(log_dir, 'log.txt', shift_d=False, stampout=False)
+
+    sf_kwargs = dict(verbose=args.verbose,
+                     completion=RxCompletion(timeout=args.rx_timeout,
+                                             gap_chars=args.rx_gap),
+                     persistent=args.persistent)
+    ports = args.port.split(",") if args.port else [None]
+    print(config)
+    print("interesting: %s" % predicate)
+    print("ports: %s" % " ".join(str(port) for port in ports))
+    hexdump(tx, label="tx %u" % len(tx))
+
+    pool = None
+    if len(ports) > 1:
+        tester = pool = PortPool(ports, config, sf_kwargs, predicate, args.tries)
+    else:
+        sf = SFuzz(port=ports[0], **sf_kwargs)
+        sf.mkser(**config._asdict())
+        tester = LocalTester(sf, predicate, args.tries)
+    try:
+        if tester.first([tx]) is None:
+            print("Doesn't reproduce in %u tries" % args.tries)
+            sys.exit(1)
+        small = ddmin(tx, tester, verbose=args.verbose)
+    finally:
+        if pool:
+            pool.close()
+
+    print("")
+    print("Minimized %u => %u bytes in %u tests" % (len(tx), len(small), tester.tests))
+    hexdump(small, label="tx %u" % len(small))
+    if pool is None:
+        for _try in range(args.tries):
+            rx = sf.txrx(small)
+            if predicate(rx):
+                break
+        hexdump(rx, label="rx %u" % len(rx))
+        print("# rx = %s" % bytes2AnonArray(rx))
+    print("sf.txrx(%s)" % bytes2AnonArray(small))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+"""
+Search a capture.sfz instead of grepping log.txt
+Indexes are built on first use and reused until the capture grows
+ex: ./query.py log/2024-01-01_01 --baudrate 9600 --rx-prefix '\r\n'
+"""
+
+import argparse
+import collections
+import os
+import sys
+import time
+
+from capture import CaptureReader, CaptureIndex, rx_prefix_range, rx_hash_key
+from main import hexdump, bytes2AnonArray, parse_escapes, SerConfig
+
+
+def capture_fn(fn):
+    '''Accept a log dir or the capture itself'''
+    if os.path.isdir(fn):
+        return os.path.join(fn, "capture.sfz")
+    return fn
+
+
+def parse_range(s):
+    '''N, MIN-MAX, MIN- => [lo, hi)'''
+    if "-" not in s:
+        return int(s, 0), int(s, 0) + 1
+    lo, hi = s.split("-", 1)
+    return int(lo or "0", 0), int(hi, 0) + 1 if hi else 1 << 32
+
+
+class Query(object):
+    '''Filters over a CaptureIndex. None matches anything'''
+    def __init__(self,
+                 index,
+                 baudrates=None,
+                 parities=None,
+                 stopbitss=None,
+                 rx_len=None,
+                 rx_prefix=None,
+                 rx=None):
+        self.index = index
+        self.reader = index.reader
+        self.baudrates = baudrates
+        self.parities = parities
+        self.stopbitss = stopbitss
+        self.rx_len = rx_len
+        self.rx_prefix = rx_prefix
+        self.rx = rx
+
+    def config_ids(self):
+        if self.baudrates is None and self.parities is None and self.stopbitss is None:
+            return None
+        ret = []
+        for configi, config in self.reader.configs.items():
+            baudrate, parity, stopbits = config[0:3]
+            if self.baudrates is not None and baudrate not in self.baudrates:
+                continue
+            if self.parities is not None and parity not in self.parities:
+                continue
+            if self.stopbitss is not None and stopbits not in self.stopbitss:
+                continue
+            ret.append(configi)
+        return ret
+
+    def lookups(self):
+        '''[(key, [(lo, hi), ...]), ...] one per indexed filter'''
+        ret = []
+        configis = self.config_ids()
+        if configis is not None:
+            ret.append(("config", [(i, i + 1) for i in configis]))
+        if self.rx is not None:
+            h = rx_hash_key(self.rx)
+            ret.append(("hash", [(h, h + 1)]))
+        if self.rx_prefix is not None:
+            ret.append(("prefix", [rx_prefix_range(self.rx_prefix)]))
+        if self.rx_len is not None:
+            ret.append(("rxlen", [self.rx_len]))
+        return ret
+
+    def candidates(self):
+        '''Rows from the most selective index, None for a full scan'''
+        best = None
+        for key, ranges in self.lookups():
+            n = 0
+            for lo, hi in ranges:
+                first, last = self.index.span(key, lo, hi)
+                n += last - first
+            if best is None or n < best[0]:
+                best = (n, key, ranges)
+        if best is None:
+            return None
+        _n, key, ranges = best
+        rows = []
+        for lo, hi in ranges:
+            rows += self.index.rows(key, lo, hi)
+        return sorted(rows)
+
+    def match(self, ex):
+        config = ex.config or [None] * 3
+        if self.baudrates is not None and config[0] not in self.baudrates:
+            return False
+        if self.parities is not None and config[1] not in self.parities:
+            return False
+        if self.stopbitss is not None and config[2] not in self.stopbitss:
+            return False
+        if self.rx_len is not None and not self.rx_len[0] <= len(ex.rx) < self.rx_len[1]:
+            return False
+        if self.rx_prefix is not None and ex.rx[0:len(self.rx_prefix)] != self.rx_prefix:
+            return False
+        if self.rx is not None and ex.rx != self.rx:
+            return False
+        return True
+
+    def __iter__(self):
+        rows = self.candidates()
+        if rows is None:
+            exchanges = iter(self.reader)
+        else:
+            exchanges = (self.index.exchange(row) for row in rows)
+        for ex in exchanges:
+            if self.match(ex):
+                yield ex
+
+
+def print_exchange(ex):
+    if ex.config:
+        print(SerConfig(*ex.config))
+    print("itr %u" % ex.itr)
+    if ex.rx_first_ns:
+        print("rx after %0.3f ms, done %0.3f ms" %
+              (ex.rx_first_ns / 1e6, ex.rx_last_ns / 1e6))
+    hexdump(ex.tx, label="tx %u" % len(ex.tx))
+    hexdump(ex.rx, label="rx %u" % len(ex.rx))
+    print("# rx = %s" % bytes2AnonArray(ex.rx))
+    print("sf.txrx(%s)" % bytes2AnonArray(ex.tx))
+
+
+def log2_bucket(ns):
+    '''Upper bound of the power of 2 microseconds ns falls in'''
+    us = 1
+    while us * 1000 < ns:
+        us *= 2
+    return us
+
+
+def print_histogram(label, nss):
+    nss = sorted(nss)
+    print("  %s: %u, p50 %0.3f ms, p99 %0.3f ms, max %0.3f ms" %
+          (label, len(nss), nss[len(nss) // 2] / 1e6,
+           nss[len(nss) * 99 // 100] / 1e6, nss[-1] / 1e6))
+    buckets = collections.Counter(log2_bucket(ns) for ns in nss)
+    most = max(buckets.values())
+    for us in sorted(buckets):
+        print("    <= %8u us %7u %s" %
+              (us, buckets[us], "#" * max(1, 40 * buckets[us] // most)))
+
+
+def latency_report(exchanges):
+    '''
+    Per serial config: time from tx to the first rx byte and gaps between
+    rx chunks (needs captures with chunk profiles for the latter)
+    '''
+    # config => ([first byte ns], [chunk gap ns])
+    configs = collections.OrderedDict()
+    for ex in exchanges:
+        if not len(ex.rx):
+            continue
+        firsts, gaps = configs.setdefault(tuple(ex.config or ()), ([], []))
+        firsts.append(ex.rx_first_ns)
+        for (prev, _n), (cur, _m) in zip(ex.chunks, ex.chunks[1:]):
+            gaps.append(cur - prev)
+    for config, (firsts, gaps) in configs.items():
+        print("")
+        print(SerConfig(*config) if config else "unknown settings")
+        print_histogram("first rx byte", firsts)
+        if gaps:
+            print_histogram("rx chunk gap", gaps)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Search a capture file')
+    parser.add_argument('capture', help='capture.sfz or the log dir holding it')
+    parser.add_argument('--baudrate', default=None, help='ex: 9600,19200')
+    parser.add_argument('--parity', default=None, help='ex: N,E')
+    parser.add_argument('--stopbits', default=None, help='ex: 1,2')
+    parser.add_argument('--rx-len', default=None, help='N, MIN-MAX or MIN-')
+    parser.add_argument('--rx-prefix', default=None, help='rx starts with, backslash escapes ok')
+    parser.add_argument('--rx', default=None, help='rx is exactly, backslash escapes ok')
+    parser.add_argument('--limit', type=int, default=50, help='Print at most this many, 0 for all')
+    parser.add_argument('--count', action='store_true', help='Only count matches')
+    parser.add_argument('--latency', action='store_true', help='Response latency histograms per serial config instead of listing matches')
+    parser.add_argument('--rebuild', action='store_true', help='Rebuild the index even if current')
+    args = parser.parse_args()
+
+    tstart = time.time()
+    reader = CaptureReader(capture_fn(args.capture), scan=False)
+    index = CaptureIndex(reader, rebuild=args.rebuild)
+    tindex = time.time()
+    print("%u exchanges, index ready in %0.1f ms" % (len(index), (tindex - tstart) * 1000), file=sys.stderr)
+
+    query = Query(
+        index,
+        baudrates=[int(x) for x in args.baudrate.split(",")] if args.baudrate else None,
+        parities=args.parity.upper().split(",") if args.parity else None,
+        stopbitss=[float(x) if "." in x else int(x) for x in args.stopbits.split(",")] if args.stopbits else None,
+        rx_len=parse_range(args.rx_len) if args.rx_len else None,
+        rx_prefix=parse_escapes(args.rx_prefix) if args.rx_prefix is not None else None,
+        rx=parse_escapes(args.rx) if args.rx is not None else None)
+
+    if args.latency:
+        latency_report(query)
+        print("done in %0.1f ms" % ((time.time() - tindex) * 1000), file=sys.stderr)
+        return
+
+    matches = 0
+    for ex in query:
+        matches += 1
+        if args.count or (args.limit and matches > args.limit):
+            continue
+        print("")
+        print_exchange(ex)
+    print("%u matches in %0.1f ms" % (matches, (time.time() - tindex) * 1000), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
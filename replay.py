@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+
+"""
+Re-send a recorded session and diff the responses
+Regression check a firmware instead of pasting sf.txrx() lines into a script
+ex: ./replay.py log/2024-01-01_01 --port /dev/ttyUSB0
+"""
+
+import argparse
+import ast
+import collections
+import os
+import re
+import sys
+import time
+
+from capture import CaptureReader, CaptureWriter
+from main import default_date_dir, mkdir_p, logwt, hexdump, bytes2AnonArray, SFuzz, SerConfig, RxCompletion, parse_escapes, add_bool_arg
+
+# t_ns: wall clock of the original tx, None if unknown
+Case = collections.namedtuple("Case", "itr config tx rx t_ns")
+
+# IOTimestamp prefix (utc / mono / ns modes)
+STAMP_RE = re.compile(r"^[0-9][0-9T:.\-]*: ")
+SETTINGS_RE = re.compile(
+    r"^baudrate=(\d+), parity=(\w), stopbits=([0-9.]+)((?:, \w+=True)*)$")
+
+
+def capture_cases(fn):
+    reader = CaptureReader(fn)
+    ex = None
+    for ex in reader:
+        yield Case(ex.itr,
+                   SerConfig(*ex.config) if ex.config else None,
+                   bytes(ex.tx), bytes(ex.rx), ex.t_ns)
+    # Views into the mmap must go before it can close
+    ex = None
+    reader.close()
+
+
+def parse_settings(line):
+    m = SETTINGS_RE.match(line)
+    if not m:
+        return None
+    baudrate, parity, stopbits, flags = m.groups()
+    stopbits = float(stopbits) if "." in stopbits else int(stopbits)
+    return SerConfig(int(baudrate), parity, stopbits, "rtscts" in flags,
+                     "dsrdtr" in flags, "xonxoff" in flags)
+
+
+def parse_literal(text):
+    '''b"..." b"..." out of a bytes2AnonArray() dump'''
+    return ast.literal_eval(text[text.index('b"'):text.rindex('"') + 1])
+
+
+def log_cases(fn):
+    '''
+    Cases printed to a log.txt
+    Only what got logged: silent and repeated responses aren't in there
+    '''
+    config = None
+    rx = None
+    # "rx" or "tx", text so far
+    pending = None
+    itr = 0
+    for line in open(fn, errors="replace"):
+        line = STAMP_RE.sub("", line.rstrip("\n"))
+        if pending and line.lstrip().startswith('b"'):
+            pending[1] += " " + line.strip()
+            continue
+        if pending:
+            what, text = pending
+            pending = None
+            if what == "rx":
+                rx = parse_literal(text)
+            else:
+                itr += 1
+                yield Case(itr, config, parse_literal(text), rx or b"", None)
+                rx = None
+        line = line.strip()
+        settings = parse_settings(line)
+        if settings:
+            config = settings
+        elif line.startswith("# rx = "):
+            pending = ["rx", line]
+        elif line.startswith("sf.txrx("):
+            pending = ["tx", line]
+    if pending and pending[0] == "tx":
+        yield Case(itr + 1, config, parse_literal(pending[1]), rx or b"", None)
+
+
+def session_cases(path):
+    '''Capture file, log.txt or a log dir holding either'''
+    if os.path.isdir(path):
+        fn = os.path.join(path, "capture.sfz")
+        if os.path.exists(fn):
+            return capture_cases(fn)
+        return log_cases(os.path.join(path, "log.txt"))
+    with open(path, 'rb') as f:
+        if f.read(6) == b"SFZCAP":
+            return capture_cases(path)
+    return log_cases(path)
+
+
+class Replay(object):
+    '''
+    timing: wait out the original gaps between cases
+    batch: send up to this many cases that were silent at the same settings
+    in one write. If the batch gets any response its cases are sent again
+    one at a time so the response can be attributed
+    (note the target then sees them twice)
+    '''
+    def __init__(self, sf, default_config=None, timing=False, batch=1):
+        self.sf = sf
+        self.default_config = default_config
+        self.timing = timing
+        self.batch = batch
+        self.config = None
+        self.cases = 0
+        self.same = 0
+        self.differ = []
+        self.batches = 0
+        self.replays = 0
+        self.tstart = None
+        self.t0_ns = None
+
+    def configure(self, config):
+        if config is None:
+            config = self.default_config
+            if config is None:
+                raise Exception("Serial settings weren't recorded, give --baudrate")
+        if config != self.config:
+            self.sf.print_settings(config)
+            self.sf.mkser(**config._asdict())
+            self.sf.ser_settings = config
+            self.config = config
+
+    def wait(self, case):
+        if not self.timing or case.t_ns is None:
+            return
+        if self.t0_ns is None:
+            self.t0_ns = case.t_ns
+        wait = self.tstart + (case.t_ns - self.t0_ns) / 1e9 - time.time()
+        if wait > 0:
+            time.sleep(wait)
+
+    def check(self, case, rx):
+        self.cases += 1
+        if self.sf.capture:
+            self.sf.capture.exchange(case.itr, self.config, case.tx, rx,
+                                     *self.sf.rx_times())
+        if rx == case.rx:
+            self.same += 1
+            sys.stdout.write(".")
+            sys.stdout.flush()
+            return
+        self.differ.append(case.itr)
+        print("")
+        print("itr %u: rx differs" % case.itr)
+        hexdump(case.tx, label="tx %u" % len(case.tx))
+        hexdump(case.rx, label="recorded rx %u" % len(case.rx))
+        hexdump(rx, label="rx %u" % len(rx))
+        print("# rx = %s" % bytes2AnonArray(rx))
+        print("sf.txrx(%s)" % bytes2AnonArray(case.tx))
+
+    def send_one(self, case):
+        self.configure(case.config)
+        self.wait(case)
+        self.check(case, self.sf.txrx(case.tx))
+
+    def send_batch(self, cases):
+        self.configure(cases[0].config)
+        self.batches += 1
+        self.sf.tx_ns = time.time_ns()
+        self.sf.write(b"".join(case.tx for case in cases))
+        self.sf.ser.flush()
+        self.sf.tx_done_ns = self.sf.clock()
+        rx = self.sf.read_response()
+        if not rx:
+            for case in cases:
+                self.check(case, rx)
+            return
+        print("")
+        print("batch of %u got rx %u, replaying one at a time" %
+              (len(cases), len(rx)))
+        self.replays += 1
+        for case in cases:
+            self.send_one(case)
+
+    def batchable(self, case):
+        return self.batch > 1 and not self.timing and not case.rx
+
+    def send(self, batch):
+        if len(batch) > 1:
+            self.send_batch(batch)
+        elif batch:
+            self.send_one(batch[0])
+
+    def run(self, cases):
+        self.tstart = time.time()
+        batch = []
+        for case in cases:
+            if batch and (not self.batchable(case)
+                          or case.config != batch[0].config
+                          or len(batch) >= self.batch):
+                self.send(batch)
+                batch = []
+            if self.batchable(case):
+                batch.append(case)
+            else:
+                self.send_one(case)
+        self.send(batch)
+
+    def print_summary(self):
+        dt = time.time() - self.tstart
+        print("")
+        print("replayed %u cases in %0.1f sec (%0.1f / sec)" %
+              (self.cases, dt, self.cases / dt if dt else 0.0))
+        if self.batch > 1:
+            print("batches: %u, %u answered and replayed singly" %
+                  (self.batches, self.replays))
+        print("same: %u, differ: %u" % (self.same, len(self.differ)))
+        if self.differ:
+            print("differ at itr: %s" % " ".join(str(itr) for itr in self.differ[0:32]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded session and diff the responses")
+    parser.add_argument("session", help="capture.sfz, log.txt or a log dir")
+    parser.add_argument("--port", default=None, help="Serial port")
+    parser.add_argument("--dir", default=None, help="Output dir")
+    parser.add_argument("--postfix", default="replay", help="")
+    parser.add_argument("--baudrate", default=None, type=int, help="Settings for cases that didn't record any")
+    parser.add_argument("--parity", default="N", help="Settings for cases that didn't record any")
+    parser.add_argument("--stopbits", default=1, type=float, help="Settings for cases that didn't record any")
+    parser.add_argument("--timing", action="store_true", help="Keep the original time between cases")
+    parser.add_argument("--batch", default=1, type=int, help="Send up to this many recorded silent cases per write")
+    parser.add_argument("--start", default=0, type=int, help="Skip cases before this itr")
+    parser.add_argument("--count", default=None, type=int, help="Replay at most this many cases")
+    parser.add_argument("--rx-timeout", default=None, type=float, help="Seconds to wait for the first response byte (default: adapter latency + 10 character times)")
+    parser.add_argument("--rx-gap", default=4, type=float, help="Response is over after this many idle character times")
+    parser.add_argument("--rx-term", default=None, help="Response is over after this terminator (ex: \\r\\n)")
+    add_bool_arg(parser, "--persistent", default=True, help="Keep the port open and reconfigure in place")
+    add_bool_arg(parser, "--capture", default=True, help="Record the replay to capture.sfz in the output dir")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    completion = RxCompletion(timeout=args.rx_timeout, gap_chars=args.rx_gap)
+    if args.rx_term:
+        completion.terminator = parse_escapes(args.rx_term)
+
+    default_config = None
+    if args.baudrate:
+        stopbits = int(args.stopbits) if args.stopbits == int(args.stopbits) else args.stopbits
+        default_config = SerConfig(args.baudrate, args.parity.upper(), stopbits,
+                                   False, False, False)
+
+    log_dir = args.dir
+    if log_dir is None:
+        log_dir = default_date_dir("log", "", args.postfix)
+    mkdir_p(log_dir)
+    _dt = logwt(log_dir, 'log.txt', shift_d=False, stampout=False, buffered=True)
+
+    capture = None
+    if args.capture:
+        capture = CaptureWriter(os.path.join(log_dir, "capture.sfz"),
+                                session=dict(port=args.port, argv=sys.argv,
+                                             replay=args.session))
+    sf = SFuzz(port=args.port,
+               verbose=args.verbose,
+               completion=completion,
+               persistent=args.persistent,
+               capture=capture)
+    print("Replaying %s" % args.session)
+    cases = (case for case in session_cases(args.session) if case.itr >= args.start)
+    if args.count is not None:
+        cases = (case for _i, case in zip(range(args.count), cases))
+    replay = Replay(sf, default_config=default_config, timing=args.timing,
+                    batch=args.batch)
+    replay.run(cases)
+    if not replay.cases:
+        # Nothing was checked, don't pass as a regression gate
+        print("No cases found in %s (log.txt only has them with --repro txrx, the default)" % args.session)
+        sys.exit(1)
+    replay.print_summary()
+    sys.exit(1 if replay.differ else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+"""
+Simulated targets: fuzz without hardware, in simulated time
+
+    sf = SFuzz(port="sim", transport=EchoDevice(baudrate=9600).open)
+
+SimSerial stands in for serial.Serial. Nothing sleeps: writes advance a
+simulated clock by the time the bytes take on the wire, responses arrive
+after the device's latency and SFuzz reads them straight off the queue
+Line settings that don't match the device's garble traffic both ways,
+see reframe()
+"""
+
+import collections
+import random
+import zlib
+
+# Baud rates closer than this still sample fine
+BAUD_TOLERANCE = 0.04
+
+
+def char_ns(baudrate, bytesize=8, parity='N', stopbits=1):
+    bits = 1 + bytesize + stopbits
+    if parity != 'N':
+        bits += 1
+    return int(bits * 1e9 / baudrate)
+
+
+def parity_bit(b, parity):
+    ones = bin(b).count("1")
+    return {
+        'E': ones % 2,
+        'O': 1 - ones % 2,
+        'M': 1,
+        'S': 0,
+    }[parity]
+
+
+def mark_byte(ret, b, error, mark):
+    '''Append b as a termios receiver would, PARMRK on if mark'''
+    if error:
+        if mark:
+            ret += b"\xFF\x00" + bytes([b])
+    elif mark and b == 0xFF:
+        ret += b"\xFF\xFF"
+    else:
+        ret.append(b)
+
+
+def reframe(data, src, dst, mark=False):
+    '''
+    data sent at src (baudrate, parity) as received at dst
+    Baud mismatch: noise of about the length the receiver would clock in,
+    the same noise for the same data, about half of it framing errors
+    Parity mismatch: the bit after the data bits is the sender's parity bit
+    or its stop bit (1). Bytes where that isn't what the receiver expects
+    are framing / parity errors
+    Errors are dropped, or with mark come as PARMRK \xFF \x00 c
+    (a real \xFF then comes doubled)
+    Stop bit mismatches are ignored
+    '''
+    src_baud, src_parity = src
+    dst_baud, dst_parity = dst
+    if abs(src_baud - dst_baud) > BAUD_TOLERANCE * dst_baud:
+        rng = random.Random(zlib.crc32(data) ^ src_baud ^ (dst_baud << 20))
+        ret = bytearray()
+        for b in rng.randbytes(len(data) * dst_baud // src_baud):
+            mark_byte(ret, b, rng.random() < 0.5, mark)
+        return bytes(ret)
+    if src_parity == dst_parity and not (mark and 0xFF in data):
+        return data
+    ret = bytearray()
+    for b in data:
+        after = 1 if src_parity == 'N' else parity_bit(b, src_parity)
+        expect = 1 if dst_parity == 'N' else parity_bit(b, dst_parity)
+        mark_byte(ret, b, after != expect, mark)
+    return bytes(ret)
+
+
+class SimDevice(object):
+    '''
+    A target that never answers, subclass and override handle()
+    baudrate / parity: what the device really uses
+    latency: seconds from the end of a tx to the start of the response
+    fifo: responses reach the host this many bytes at a time
+    '''
+    def __init__(self, baudrate=115200, parity='N', latency=0.0005, fifo=16):
+        self.baudrate = baudrate
+        self.parity = parity
+        self.latency = latency
+        self.fifo = fifo
+
+    def handle(self, data):
+        '''Bytes as the device received them => response bytes or None'''
+        return None
+
+    def reset(self):
+        '''DTR / RTS pulse'''
+        pass
+
+    def open(self, port=None, **settings):
+        '''SFuzz transport: SFuzz(port="sim", transport=device.open)'''
+        return SimSerial(self, port, **settings)
+
+
+class EchoDevice(SimDevice):
+    def handle(self, data):
+        return data
+
+
+class LineDevice(SimDevice):
+    '''
+    Line based command interpreter
+    commands: line (no terminator) => response, others get error
+    '''
+    def __init__(self, commands=None, error=b"ERR\r\n", eol=b"\r", **kwargs):
+        SimDevice.__init__(self, **kwargs)
+        self.commands = commands or {b"AT": b"OK\r\n", b"?": b"HELP\r\n"}
+        self.error = error
+        self.eol = eol
+        self.buf = b""
+
+    def handle(self, data):
+        self.buf += data
+        ret = b""
+        while self.eol in self.buf:
+            line, self.buf = self.buf.split(self.eol, 1)
+            line = line.strip(b"\r\n")
+            if line:
+                ret += self.commands.get(line, self.error)
+        return ret
+
+    def reset(self):
+        self.buf = b""
+
+
+SIM_DEVICES = collections.OrderedDict([
+    ("silent", SimDevice),
+    ("echo", EchoDevice),
+    ("line", LineDevice),
+])
+
+
+class SimSerial(object):
+    '''
+    Enough of serial.Serial for SFuzz, connected to a SimDevice
+    monotonic_ns() is the simulated clock, SFuzz times exchanges with it
+    parmrk: mark rx errors like termios PARMRK, see SFuzz.set_parmrk()
+    '''
+    def __init__(self,
+                 device,
+                 port=None,
+                 baudrate=9600,
+                 bytesize=8,
+                 parity='N',
+                 stopbits=1,
+                 rtscts=False,
+                 dsrdtr=False,
+                 xonxoff=False,
+                 timeout=None,
+                 writeTimeout=None):
+        self.device = device
+        self.port = port
+        self.timeout = timeout
+        self.is_open = True
+        self.clock_ns = 0
+        self.parmrk = False
+        # [arrival ns, data]
+        self.pending = collections.deque()
+        self._dtr = True
+        self._rts = True
+        self.apply_settings(
+            dict(baudrate=baudrate,
+                 bytesize=bytesize,
+                 parity=parity,
+                 stopbits=stopbits,
+                 rtscts=rtscts,
+                 dsrdtr=dsrdtr,
+                 xonxoff=xonxoff))
+
+    def apply_settings(self, settings):
+        for k, v in settings.items():
+            setattr(self, k, v)
+
+    def monotonic_ns(self):
+        return self.clock_ns
+
+    def write(self, data):
+        data = bytes(data)
+        self.clock_ns += len(data) * char_ns(self.baudrate, self.bytesize,
+                                             self.parity, self.stopbits)
+        host = (self.baudrate, self.parity)
+        dev = (self.device.baudrate, self.device.parity)
+        response = self.device.handle(reframe(data, host, dev))
+        if response:
+            response = reframe(bytes(response), dev, host, mark=self.parmrk)
+        if response:
+            start = self.clock_ns + int(self.device.latency * 1e9)
+            per_char = char_ns(self.device.baudrate, self.bytesize,
+                               self.device.parity)
+            for i in range(0, len(response), self.device.fifo):
+                chunk = response[i:i + self.device.fifo]
+                self.pending.append(
+                    [start + (i + len(chunk)) * per_char, chunk])
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def read_response(self, completion, first, idle):
+        '''
+        SFuzz.read_response() in simulated time
+        first / idle: seconds to wait for the first / next byte
+        Returns (rx, [(ns, bytes)] per chunk)
+        '''
+        ret = bytearray()
+        chunks = []
+        deadline = self.clock_ns + int(first * 1e9)
+        while self.pending and self.pending[0][0] <= deadline:
+            if completion.done(ret):
+                return ret, chunks
+            arrival, data = self.pending.popleft()
+            # Already waiting in the buffer: read now
+            arrival = max(arrival, self.clock_ns)
+            room = completion.max_size - len(ret)
+            if len(data) > room:
+                self.pending.appendleft([arrival, data[room:]])
+                data = data[:room]
+            ret += data
+            chunks.append((arrival, len(data)))
+            self.clock_ns = arrival
+            deadline = self.clock_ns + int(idle * 1e9)
+        if not completion.done(ret):
+            # Waited it out
+            self.clock_ns = max(self.clock_ns, deadline)
+        return ret, chunks
+
+    @property
+    def in_waiting(self):
+        return sum(len(data) for arrival, data in self.pending
+                   if arrival <= self.clock_ns)
+
+    def read(self, size=1):
+        ret = bytearray()
+        while self.pending and self.pending[0][0] <= self.clock_ns and len(ret) < size:
+            arrival, data = self.pending.popleft()
+            room = size - len(ret)
+            if len(data) > room:
+                self.pending.appendleft([arrival, data[room:]])
+                data = data[:room]
+            ret += data
+        return bytes(ret)
+
+    def reset_input_buffer(self):
+        while self.pending and self.pending[0][0] <= self.clock_ns:
+            self.pending.popleft()
+
+    @property
+    def dtr(self):
+        return self._dtr
+
+    @dtr.setter
+    def dtr(self, value):
+        if self._dtr and not value:
+            self.device.reset()
+        self._dtr = value
+
+    @property
+    def rts(self):
+        return self._rts
+
+    @rts.setter
+    def rts(self, value):
+        self._rts = value
+
+    def close(self):
+        self.is_open = False